@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+"""Measure startup cost of the applications
+
+Each application is started in a fresh interpreter several times, the median time of importing
+the connector with client libraries used by the application is printed and, if an output file is
+given, appended to it as CSV, so regressions are visible between versions:
+
+    python benchmarks/import_time.py --output import_time.csv
+"""
+import argparse
+import csv
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# clients used by each application, see ConnectorMixin properties
+ENTRY_POINTS = {
+    'cloudblue-fulfillments': ('CinderClient', 'MagnumClient', 'NeutronClient', 'NovaClient', 'OctaviaClient'),
+    'cloudblue-usage': ('GlanceClient', 'GnocchiClient'),
+    'cloudblue-usage-files': (),
+    # usage and usage-files jobs
+    'cloudblue-daemon': ('GlanceClient', 'GnocchiClient'),
+}
+
+CODE = '''
+import time
+started = time.perf_counter()
+import cloudblue_connector.runners
+from cloudblue_connector import connector
+for name in {clients!r}:
+    getattr(connector, name).resolve()
+print(time.perf_counter() - started)
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(clients):
+    """Return seconds to import the connector and seconds to run the interpreter"""
+
+    started = time.perf_counter()
+    output = subprocess.check_output([sys.executable, '-c', CODE.format(clients=clients)], cwd=ROOT)
+    return float(output.decode().strip().splitlines()[-1]), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per application')
+    parser.add_argument('--output', help='CSV file to append results to')
+    args = parser.parse_args()
+
+    version = None
+    if os.path.isfile(os.path.join(ROOT, 'Makefile.version')):
+        with open(os.path.join(ROOT, 'Makefile.version')) as f:
+            version = f.read().strip()
+
+    rows = []
+    for entry_point, clients in sorted(ENTRY_POINTS.items()):
+        runs = [measure(clients) for _ in range(args.repeat)]
+        imports = statistics.median(run[0] for run in runs) * 1000
+        process = statistics.median(run[1] for run in runs) * 1000
+        print('{:<24} imports {:8.1f} ms   process {:8.1f} ms'.format(entry_point, imports, process))
+        rows.append((time.strftime('%Y-%m-%dT%H:%M:%S'), version, entry_point, round(imports, 1), round(process, 1)))
+
+    if args.output:
+        exists = os.path.exists(args.output)
+        with open(args.output, 'a') as f:
+            writer = csv.writer(f)
+            if not exists:
+                writer.writerow(('time', 'version', 'entry_point', 'imports_ms', 'process_ms'))
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+"""Compare measures reducers with the list code of consumption collectors they replaced
+
+Each reducer and its previous version are run on 5 minutes measures of a day and of a fleet wide
+groupby, runs are interleaved and the best time of each is printed:
+
+    python benchmarks/measures_reducers.py
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cloudblue_connector.consumption.measures import hourly_sum, hourly_average, positive_delta_sum  # noqa: E402
+
+
+def legacy_hourly_sum(measures):
+    return sum([m[-1] for m in measures if m[0].minute == 0] or [0])
+
+
+def legacy_hourly_average(measures):
+    hours = max(len([m for m in measures if m[0].minute == 0]), 1)
+    values = [m[-1] for m in measures] or [0]
+    return (float(sum(values)) / len(values)) * hours
+
+
+def legacy_positive_delta_sum(measures):
+    result = 0.0
+    if len(measures):
+        previous_value = measures[0][2]
+        for m in measures:
+            if previous_value < m[2]:
+                result += m[2] - previous_value
+            previous_value = m[2]
+    return result
+
+
+REDUCERS = (
+    (hourly_sum, legacy_hourly_sum),
+    (hourly_average, legacy_hourly_average),
+    (positive_delta_sum, legacy_positive_delta_sum),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[288, 100000], help='measures per series')
+    parser.add_argument('--repeat', type=int, default=7, help='runs per reducer')
+    args = parser.parse_args()
+
+    start = datetime(2020, 6, 28)
+    for points in args.points:
+        measures = [[start + timedelta(minutes=5 * i), 300.0, float(i * 7 % 1000)] for i in range(points)]
+        number = max(300000 // points, 1)
+        for reducer, legacy in REDUCERS:
+            assert reducer(measures) == legacy(measures), reducer.__name__
+            timings = {reducer: [], legacy: []}
+            for _ in range(args.repeat):
+                for function in timings:
+                    timings[function].append(timeit.timeit(lambda: function(measures), number=number) / number)
+            new, old = min(timings[reducer]), min(timings[legacy])
+            print('{:>8} points {:<20} {:10.1f} us   previous {:10.1f} us   {:5.2f}x'.format(
+                points, reducer.__name__, new * 1e6, old * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,8 @@ from connect.resources import Directory
 from connect.rql import Query
 
 from cloudblue_connector.connector import ConnectorMixin
-from cloudblue_connector.core.logger import context_log
+from cloudblue_connector.core.history import History, tracked
+from cloudblue_connector.core.logger import context_log, Summary
 from cloudblue_connector.quota import BadQuota, CinderQuotaUpdater, NovaQuotaUpdater, \
     NeutronQuotaUpdater, OctaviaQuotaUpdater, MagnumQuotaUpdater
 
@@ -32,7 +33,10 @@ def pwgen(length=24):
 class FulfillmentAutomation(resources.FulfillmentAutomation, ConnectorMixin):
     """This is the automation engine for Fulfillments processing"""
 
-    fulfillments = []
+    def __init__(self, config=None):
+        super(FulfillmentAutomation, self).__init__(config)
+        # processed requests for debug
+        self.history = History()
 
     def get_tier_partner_data(self, account_id=None):
         """Look for domain name in tier1 configuration data. `partner_id` keeps this information for us"""
@@ -47,15 +51,13 @@ class FulfillmentAutomation(resources.FulfillmentAutomation, ConnectorMixin):
 
         return None
 
+    @tracked
     @context_log
     def process_request(self, request):
         """Each new Fulfillment is processed by this function"""
 
         conf = Config.get_instance()
 
-        # store all processed request for debug
-        self.fulfillments.append(request)
-
         if request.needs_migration():
             # Skip request if it needs migration
             # (migration is performed by an external service)
@@ -204,7 +206,8 @@ class FulfillmentAutomation(resources.FulfillmentAutomation, ConnectorMixin):
                 return quantity
 
             items = {item.mpn.lower(): item for item in request.asset.items}
-            self.logger.info('VIP requested items %r', items)
+            self.logger.info('VIP requested items %s',
+                             Summary(items.values(), key=lambda item: '{}={}'.format(item.mpn, item.quantity)))
             try:
                 # get quota limits from Asset parameters
                 cpu_quota = get_quota(items.get('cpu_limit', items.get("cpu_consumption", None)))
@@ -3,6 +3,11 @@
 # This source code is distributed under MIT software license.
 # ******************************************************************************
 
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+from copy import copy
 from datetime import datetime, timedelta
 
 from connect import resources
@@ -15,18 +20,211 @@ from keystoneclient.exceptions import NotFound as KeystoneNotFound
 from cloudblue_connector.automation.usage_file import UsageFileAutomation
 from cloudblue_connector.connector import ConnectorMixin
 from cloudblue_connector.consumption import CPU, Storage, RAM, FloatingIP, LoadBalancer, K8saas, WinVM,\
-    OutgoingTraffic, Zero
-from cloudblue_connector.core.logger import context_log
+    OutgoingTraffic, Zero, ConsumptionError, GroupedMeasures, share_measures
+from cloudblue_connector.consumption.cache import catch_up_window
+from cloudblue_connector.core.history import History, tracked
+from cloudblue_connector.core.logger import context_log, context_bound, phase, set_context
 
 
 class UsageAutomation(resources.UsageAutomation, ConnectorMixin):
     """Automates reporting of Usage Files"""
 
-    usages = []
+    name_format = 'Report for {asset} {date}'
+    # usage files listed per request, see list_usage_files
+    page_limit = 100
 
     def __init__(self, project_id=None):
+        # current request and its logger are kept per thread,
+        # so concurrently processed Assets do not mix their log context
+        self._local = threading.local()
         super(UsageAutomation, self).__init__()
         self.project_id = project_id
+        # processed Assets for debug
+        self.history = History()
+        self.prefetched = None
+        # index of projects by id, see prefetch_projects
+        self.projects = None
+        # usage files indexed by report date and name, see find_usage_files
+        self.usage_files = None
+        self._usage_files_lock = threading.Lock()
+        # consumption collectors of all Assets, see collect_consumptions_concurrently
+        self.collectors = None
+
+    @property
+    def _current_request(self):
+        return getattr(self._local, 'current_request', None)
+
+    @_current_request.setter
+    def _current_request(self, request):
+        self._local.current_request = request
+
+    @property
+    def _logger_adapter(self):
+        return getattr(self._local, 'logger_adapter', None)
+
+    @_logger_adapter.setter
+    def _logger_adapter(self, adapter):
+        self._local.logger_adapter = adapter
+
+    def process(self, filters=None):
+        """Process Assets, in parallel if `usageWorkers` is greater than one"""
+
+        return self.process_all(filters)
+
+    def process_all(self, *filters):
+        """Process Assets of all filters in a single run sharing prefetched data
+
+        Assets matching several filters are processed once.
+        """
+
+        conf = Config.get_instance()
+        if conf.misc.get('keystonePrefetch'):
+            self.prefetch_projects()
+        if conf.misc.get('gnocchiPrefetch'):
+            self.prefetch_consumption()
+        # usage files are listed once per report date when they are first needed
+        self.usage_files = {} if conf.misc.get('usageFilesPrefetch') else None
+
+        summary = Counter()
+        requests = self.list_all(filters, summary)
+
+        # collectors of all Assets share one pool created for the run
+        collector_workers = int(conf.misc.get('collectorWorkers') or 1)
+        if collector_workers > 1:
+            self.collectors = ThreadPoolExecutor(max_workers=collector_workers)
+        try:
+            self.dispatch_all(requests, int(conf.misc.get('usageWorkers') or 1))
+        finally:
+            if self.collectors is not None:
+                self.collectors.shutdown()
+                self.collectors = None
+
+        self.logger.info("Processed %s assets (%s), %s listed more than once",
+                         sum(summary[status] for status in summary if status != 'duplicate'),
+                         ", ".join("{} {}".format(count, status) for status, count in sorted(summary.items())
+                                   if status != 'duplicate') or "none",
+                         summary['duplicate'])
+        return summary
+
+    def dispatch_all(self, requests, workers):
+        """Dispatch Assets one by one or with a pool of workers"""
+
+        if workers <= 1:
+            for request in requests:
+                self.dispatch_request(request)
+        else:
+            self.logger.info("Processing assets with %s workers", workers)
+            failed = threading.Event()
+
+            def dispatch_request(request):
+                try:
+                    return self.dispatch_request(request)
+                except BaseException:
+                    failed.set()
+                    raise
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Assets are submitted while they are listed, at most twice as many as workers
+                # are in flight, so processing starts with the first page of a lazy listing
+                pending = deque()
+                try:
+                    for request in requests:
+                        if failed.is_set():
+                            # no more Assets are submitted after a failure, as in sequential processing
+                            break
+                        if len(pending) >= 2 * workers:
+                            # results are consumed in listing order, so the first failed
+                            # Asset is reported the same way as in sequential processing
+                            pending.popleft().result()
+                        pending.append(executor.submit(dispatch_request, request))
+                    while pending:
+                        pending.popleft().result()
+                finally:
+                    # Assets that have not started yet are not processed after a failure
+                    for future in pending:
+                        future.cancel()
+
+    def list_all(self, filters, summary):
+        """List Assets of all filters one after another, skipping already listed ones
+
+        An Asset which status changed between listings is processed in both states.
+        """
+
+        listed = set()
+        for f in filters:
+            for request in self.list(f):
+                if (request.id, request.status) in listed:
+                    summary['duplicate'] += 1
+                    continue
+                listed.add((request.id, request.status))
+                summary[request.status] += 1
+                yield request
+
+    def prefetch_projects(self):
+        """List all projects with one request and index them by id"""
+
+        with phase('keystone'):
+            self.projects = {project.id: project for project in self.keystone_client.projects.list()}
+        self.logger.info("Prefetched %s projects", len(self.projects))
+
+    def prefetch_consumption(self):
+        """Fetch aggregated consumption of all projects for the daily report window"""
+
+        end_time = (datetime.utcnow() - timedelta(minutes=10)).replace(hour=0, minute=0, second=0, microsecond=0)
+        start_time = end_time - timedelta(days=1)
+        self.logger.info("Prefetch consumption from %s to %s", start_time, end_time)
+
+        self.prefetched = GroupedMeasures(start_time, end_time)
+        for consumption in (CPU(), RAM(), FloatingIP(), LoadBalancer(), K8saas()):
+            self.prefetched.prefetch(consumption)
+
+    def list_usage_files(self, report_date):
+        """List usage files of all Assets reported for the date and index them by name"""
+
+        usage_files = UsageFileAutomation()
+        index = {}
+        offset = 0
+        while True:
+            filters = Query().like('name', self.name_format.format(asset='*', date=report_date))
+            if self.config.products:
+                filters.in_('product_id', self.config.products)
+            filters.limit(self.page_limit)
+            if offset:
+                filters.offset(offset)
+            with phase('connect'):
+                page = usage_files.list(filters) or []
+            for usage_file in page:
+                index.setdefault(usage_file.name, []).append(usage_file)
+            if len(page) < self.page_limit:
+                break
+            offset += self.page_limit
+        self.logger.info("Listed %s usage files reported for %s", offset + len(page), report_date)
+        return index
+
+    def find_usage_files(self, report_name, report_date):
+        """Return usage files with the name, from the index if `usageFilesPrefetch` is enabled"""
+
+        if self.usage_files is None:
+            filters = Query().equal('name', report_name).limit(10)
+            if self.config.products:
+                filters.in_('product_id', self.config.products)
+            with phase('connect'):
+                return UsageFileAutomation().list(filters)
+
+        # concurrent workers wait for the same listing
+        with self._usage_files_lock:
+            if report_date not in self.usage_files:
+                self.usage_files[report_date] = self.list_usage_files(report_date)
+        return self.usage_files[report_date].get(report_name, [])
+
+    def dispatch_request(self, request):
+        """Dispatch single Asset in the current thread"""
+
+        self._set_current_request(request)
+        try:
+            return self.dispatch(request)
+        finally:
+            self._set_current_request(None)
 
     def get_project(self, request):
         project_id = next(p for p in request.params
@@ -34,37 +232,49 @@ class UsageAutomation(resources.UsageAutomation, ConnectorMixin):
         if not project_id:
             self.logger.error('%s: project id is None', request.id)
             return
+        if self.projects is not None and project_id in self.projects:
+            return self.projects[project_id]
         try:
-            return self.keystone_client.projects.get(project_id)
+            with phase('keystone'):
+                project = self.keystone_client.projects.get(project_id)
         except KeystoneNotFound:
             self.logger.error('%s-%s: project not found', request.id, project_id)
+            return
+        if self.projects is not None and project:
+            self.projects[project_id] = project
+        return project
 
     def update_last_report_time(self, project, report_time, confirmed=False):
         """Store last repost time in project metadata"""
 
-        self.keystone_client.projects.update(
-            project, last_usage_report_time=report_time.isoformat(),
-            last_usage_report_confirmed=confirmed)
+        with phase('keystone'):
+            updated = self.keystone_client.projects.update(
+                project, last_usage_report_time=report_time.isoformat(),
+                last_usage_report_confirmed=confirmed)
+        if self.projects is not None:
+            # keep the index up to date, the project is fetched again if it is not returned
+            if updated:
+                self.projects[project.id] = updated
+            else:
+                self.projects.pop(project.id, None)
 
     def _format_usage_record_id(self, project, report_time, mpn):
         return "{}-{}-{}".format(project.id, report_time.isoformat(), mpn)
 
+    @tracked
     @context_log
     def process_request(self, request):
         """Generate UsageFile for each active Asset"""
 
-        # store each processed request for debug
-        self.usages.append(request)
-
         if self.test_marketplace_requests_filter(Config.get_instance(), request.id, request.marketplace):
             return
 
         today = datetime.utcnow() - timedelta(minutes=10)
-        name_format = 'Report for {asset} {date}'
 
         project = self.get_project(request)
         if not project:
             return
+        set_context(project_id=project.id)
 
         stop_report_time = self.get_stop_report_time(request, project)
         start_report_time = self.get_start_report_time(request, project)
@@ -84,15 +294,11 @@ class UsageAutomation(resources.UsageAutomation, ConnectorMixin):
 
         # check that previous report has passed validation
         if confirmed is False:
-            usage_files = UsageFileAutomation()
             try:
                 report_date = last_report_time.strftime('%Y-%m-%d')
-                report_name = name_format.format(asset=request.id, date=report_date)
+                report_name = self.name_format.format(asset=request.id, date=report_date)
 
-                filters = Query().equal('name', report_name).limit(10)
-                if self.config.products:
-                    filters.in_('product_id', self.config.products)
-                found = usage_files.list(filters)
+                found = self.find_usage_files(report_name, report_date)
 
                 found = [f for f in found or [] if f.status != 'deleted']
                 self.logger.debug("Found usage files: %s", found)
@@ -132,20 +338,75 @@ class UsageAutomation(resources.UsageAutomation, ConnectorMixin):
             self.logger.info("%s-%s: usage is already reported", request.id, project.id)
             return
 
+        # catch up with the following missing days of an active asset in the same run
+        catch_up_days = int(Config.get_instance().misc.get('catchUpDays') or 1)
+        if catch_up_days <= 1 or request.status in ['suspended', 'terminated'] \
+                or report_time - last_report_time != timedelta(days=1):
+            self.report_usage(request, project, last_report_time, report_time, today)
+            return
+
+        windows = [(last_report_time, report_time)]
+        while len(windows) < catch_up_days and windows[-1][1] + timedelta(days=1) <= today:
+            windows.append((windows[-1][1], windows[-1][1] + timedelta(days=1)))
+        if len(windows) == 1:
+            # the asset is one day behind, no usage files of the following days to look up
+            self.report_usage(request, project, last_report_time, report_time, today)
+            return
+        self.catch_up(request, project, windows, today)
+
+    def catch_up(self, request, project, windows, today):
+        """Report missing days one by one, skipping days reported by previous runs
+
+        Last report time is not moved past a report which is not accepted yet, so
+        reports of all days are checked by the following runs. Catching up stops
+        at a report which is being processed or has failed.
+        """
+
+        self.logger.info("%s-%s: catching up %s days from %s to %s",
+                         request.id, project.id, len(windows), windows[0][0], windows[-1][1])
+        accepted = True
+        with catch_up_window(windows[0][0], windows[-1][1]):
+            for start_time, end_time in windows:
+                report_date = end_time.strftime('%Y-%m-%d')
+                report_name = self.name_format.format(asset=request.id, date=report_date)
+                found = [f for f in self.find_usage_files(report_name, report_date) or [] if f.status != 'deleted']
+
+                if not found:
+                    self.report_usage(request, project, start_time, end_time, today, update=accepted)
+                    accepted = False
+                    continue
+
+                report = found[0]
+                if report.status in ('processing', 'draft', 'uploading'):
+                    self.logger.info("%s-%s: usage report '%s' is being processed", request.id, project.id, report_name)
+                    return
+
+                if report.status in ('invalid', 'rejected'):
+                    # we have to wait when user remove invalid report
+                    self.logger.error("%s-%s: failed usage report '%s' found", request.id, project.id, report_name)
+                    return
+
+                if accepted:
+                    self.update_last_report_time(project, end_time, confirmed=True)
+
+    def report_usage(self, request, project, last_report_time, report_time, today, update=True):
+        """Submit UsageFile of the Asset for the window and store last report time if `update` is set"""
+
         usage_file = UsageFile(
-            name=name_format.format(asset=request.id, date=report_time.strftime('%Y-%m-%d')),
+            name=self.name_format.format(asset=request.id, date=report_time.strftime('%Y-%m-%d')),
             product=Product(id=request.product.id),
             contract=Contract(id=request.contract.id),
-            description=name_format.format(asset=request.id, date=report_time.strftime('%Y-%m-%d')),
+            description=self.name_format.format(asset=request.id, date=report_time.strftime('%Y-%m-%d')),
         )
 
         # report for each day since last report date
         self.logger.info("%s-%s: creating report from %s to %s", request.id, project.id, last_report_time, report_time)
         items = {item.mpn: item for item in request.items}
         usage_records = self.collect_usage_records(items, project, last_report_time, report_time)
-        self.submit_usage(usage_file=usage_file, usage_records=usage_records)
+        with phase('connect'):
+            self.submit_usage(usage_file=usage_file, usage_records=usage_records)
 
-        if report_time > today:
+        if report_time > today or not update:
             # when project id is specified we allow to send usage for today
             # but don't update last report time
             return
@@ -156,12 +417,12 @@ class UsageAutomation(resources.UsageAutomation, ConnectorMixin):
         """Create UsageRecord object for each type of resources"""
 
         consumptions = {
-            'CPU_consumption': CPU(),
+            'CPU_consumption': CPU(self.prefetched),
             'Storage_consumption': Storage(),
-            'RAM_consumption': RAM(),
-            'Floating_IP_consumption': FloatingIP(),
-            'LB_consumption': LoadBalancer(),
-            'K8S_consumption': K8saas(),
+            'RAM_consumption': RAM(self.prefetched),
+            'Floating_IP_consumption': FloatingIP(self.prefetched),
+            'LB_consumption': LoadBalancer(self.prefetched),
+            'K8S_consumption': K8saas(self.prefetched),
             'Win_VM_consumption': WinVM(),
             'Outgoing_Traffic_consumption': OutgoingTraffic()
         }
@@ -172,12 +433,63 @@ class UsageAutomation(resources.UsageAutomation, ConnectorMixin):
         def known_resources(item):
             return item in consumptions
 
+        if conf.misc.get('gnocchiSharedMeasures'):
+            # e.g. CPU and RAM measures of instances are fetched with one request
+            share_measures(consumptions[mpn] for mpn in filter(known_resources, items))
+
         def collect_item_consumption(item):
             return self.create_record(
                 project, start_time, end_time, item,
                 consumptions.get(item).collect_consumption(project, start_time, end_time))
 
-        return map(collect_item_consumption, filter(known_resources, items))
+        workers = int(conf.misc.get('collectorWorkers') or 1)
+        if workers <= 1:
+            return map(collect_item_consumption, filter(known_resources, items))
+
+        mpns = list(filter(known_resources, items))
+        values = self.collect_consumptions_concurrently(
+            {mpn: consumptions[mpn] for mpn in mpns}, project, start_time, end_time,
+            workers, conf.misc.get('collectorTimeout'))
+        return [self.create_record(project, start_time, end_time, mpn, values[mpn]) for mpn in mpns]
+
+    def collect_consumptions_concurrently(self, consumptions, project, start_time, end_time,
+                                          workers, timeout=None):
+        """Run consumption collectors in parallel, return values by MPN"""
+
+        # the pool of the run, or one for the Asset if it is processed outside of process_all
+        executor = self.collectors or ThreadPoolExecutor(max_workers=workers)
+        futures = {
+            mpn: executor.submit(context_bound(consumption.collect_consumption), project, start_time, end_time)
+            for mpn, consumption in consumptions.items()
+        }
+        deadline = timeout and time.monotonic() + timeout
+
+        values = {}
+        errors = []
+        try:
+            for mpn, future in futures.items():
+                remaining = deadline and max(deadline - time.monotonic(), 0)
+                try:
+                    values[mpn] = future.result(timeout=remaining)
+                except TimeoutError:
+                    errors.append("{}: timed out after {}s".format(mpn, timeout))
+                except Exception as e:
+                    self.logger.exception("%s: unable to collect '%s'", project.id, mpn)
+                    errors.append("{}: {!r}".format(mpn, e))
+        finally:
+            if errors:
+                # collectors of the failed Asset are not needed, the running ones are waited
+                # for, so they do not keep calling Gnocchi after the Asset is done
+                for future in futures.values():
+                    future.cancel()
+                wait(futures.values())
+            if executor is not self.collectors:
+                executor.shutdown()
+
+        if errors:
+            raise ConsumptionError("Unable to collect consumption for project {}: {}".format(
+                project.id, "; ".join(errors)))
+        return values
 
     def create_record(self, project, start_time, end_time, mpn, value):
         """Create UsageRecord object"""
@@ -200,16 +512,31 @@ class UsageAutomation(resources.UsageAutomation, ConnectorMixin):
     # our own version of Asset listing using Directory API
     # to have same code for TaskMarket and production
     def list(self, filters=None):
-        """List all active Assets"""
+        """List all active Assets, page by page if `assetsPageSize` is set"""
         from connect.resources.directory import Directory
         filters = filters or self.filters()
-        assets = list(Directory().list_assets(filters=filters))
-
-        for a in assets:
-            # contract's marketplace is emtpy
-            # let's use from asset
-            a.contract.marketplace = a.marketplace
-            # provider is used in debug logs
-            a.provider = a.connection.provider
-
-        return assets
+        page_size = int(Config.get_instance().misc.get('assetsPageSize') or 0)
+        directory = Directory()
+
+        offset = 0
+        while True:
+            if page_size:
+                page_filters = copy(filters) if isinstance(filters, Query) else Query(filters)
+                # pages of a stable order, so Assets are not skipped or repeated between pages
+                page_filters.order_by('id').limit(page_size).offset(offset)
+            else:
+                page_filters = filters
+            with phase('connect'):
+                assets = directory.list_assets(filters=page_filters)
+
+            for a in assets:
+                # contract's marketplace is emtpy
+                # let's use from asset
+                a.contract.marketplace = a.marketplace
+                # provider is used in debug logs
+                a.provider = a.connection.provider
+                yield a
+
+            if not page_size or len(assets) < page_size:
+                break
+            offset += page_size
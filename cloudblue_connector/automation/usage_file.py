@@ -7,13 +7,17 @@ from connect import resources
 from connect.exceptions import SubmitUsageFile, AcceptUsageFile, SkipRequest
 
 from cloudblue_connector.connector import ConnectorMixin
+from cloudblue_connector.core.history import History, tracked
 from cloudblue_connector.core.logger import context_log
 
 
 class UsageFileAutomation(resources.UsageFileAutomation, ConnectorMixin):
     """Automates workflow of Usage Files."""
 
-    files = []
+    def __init__(self, config=None):
+        super(UsageFileAutomation, self).__init__(config)
+        # processed Usage Files for debug
+        self.history = History()
 
     @context_log
     def dispatch(self, request):
@@ -25,12 +29,10 @@ class UsageFileAutomation(resources.UsageFileAutomation, ConnectorMixin):
             self.logger.exception('Error occurs while dispatching request')
         return 'skip'
 
+    @tracked
     def process_request(self, request):
         """Confirm all UsageFiles that has 'ready' status"""
 
-        # store all processed requests for debug
-        self.files.append(request)
-
         if request.status == 'ready':
             raise SubmitUsageFile()
         elif request.status == 'pending':
@@ -11,12 +11,8 @@ import sys
 from datetime import datetime
 
 import dateutil.parser
-from cinderclient.client import Client as CinderClient
-from cinderclient.exceptions import BadRequest as CinderBadRequest
 from connect.config import Config
 from connect.models import ActivationTemplateResponse, ActivationTileResponse
-from glanceclient.client import Client as GlanceClient
-from gnocchiclient.client import Client as GnocchiClient
 from keystoneauth1 import identity
 from keystoneauth1.session import Session as KeystoneSession
 from keystoneclient.exceptions import BadRequest as KeystoneBadRequest
@@ -24,16 +20,23 @@ from keystoneclient.exceptions import Conflict as KeystoneConflict
 from keystoneclient.exceptions import EndpointNotFound as KeystoneEndpointNotFound
 from keystoneclient.exceptions import NotFound as KeystoneNotFound
 from keystoneclient.v3.client import Client as KeystoneClient
-from magnumclient.client import Client as MagnumClient
-from neutronclient.v2_0.client import Client as NeutronClient
-from novaclient.client import Client as NovaClient
-from octaviaclient.api.v2.octavia import OctaviaAPI as OctaviaClient
 
 from cloudblue_connector.core import getLogger
-from cloudblue_connector.core.decorators import once, memoize, log_exception, MISSING
+from cloudblue_connector.core.decorators import once, cached, log_exception, MISSING
+from cloudblue_connector.core.imports import LazyClass
+from cloudblue_connector.core.logger import Summary
 
 LOG = getLogger("Connector")
 
+# Keystone is used by all applications, other clients are imported on first use
+CinderClient = LazyClass('cinderclient.client', 'Client')
+GlanceClient = LazyClass('glanceclient.client', 'Client')
+GnocchiClient = LazyClass('gnocchiclient.client', 'Client')
+MagnumClient = LazyClass('magnumclient.client', 'Client')
+NeutronClient = LazyClass('neutronclient.v2_0.client', 'Client')
+NovaClient = LazyClass('novaclient.client', 'Client')
+OctaviaClient = LazyClass('octaviaclient.api.v2.octavia', 'OctaviaAPI')
+
 
 class ConnectorConfig(Config):
     """Extension of CloudBlue connect config model"""
@@ -74,7 +77,24 @@ class ConnectorConfig(Config):
                     'imageUpload': True,
                     'hidePasswordsInLog': True,
                     'testMarketplaceId': None,
-                    'testMode': False
+                    'testMode': False,
+                    'usageWorkers': 1,
+                    'collectorWorkers': 1,
+                    'collectorTimeout': None,
+                    'gnocchiPrefetch': False,
+                    'gnocchiSharedMeasures': False,
+                    'gnocchiGranularity': {},
+                    'trafficRateAggregation': False,
+                    'gnocchiCachePath': None,
+                    'gnocchiCacheMaxSize': 100,
+                    'gnocchiCacheMaxAge': 7,
+                    'catchUpDays': 1,
+                    'keystonePrefetch': False,
+                    'usageFilesPrefetch': False,
+                    'assetsPageSize': None,
+                    'historySize': 100,
+                    'daemonIntervals': {},
+                    'logSampleRate': 1.0
                 })
             self._data_retention_period = int(self._read_config_value(config, 'dataRetentionPeriod', 15))
             # prepare data for connect
@@ -123,7 +143,7 @@ class ConnectorConfig(Config):
 
 
 class ConnectorMixin(object):
-    @memoize
+    @cached(ttl=3600, maxsize=256)
     def get_answer(self, product, answer):
         """Get template object specified in the Config"""
         c = Config.get_instance()
@@ -241,14 +261,14 @@ class ConnectorMixin(object):
             connect_retries=2,
         )
 
-    @memoize
     def find_role(self, name):
         """Find user role by name"""
 
         return self.keystone_client.roles.find(name=name)
 
     @log_exception
-    @memoize
+    # new images are visible within ten minutes
+    @cached(ttl=600, maxsize=16)
     def get_images_list(self, os_type=None):
         images = []
         for image in itertools.chain(self.glance_client.images.list(),
@@ -256,7 +276,7 @@ class ConnectorMixin(object):
             if image.get("os_type") and image["os_type"] == os_type:
                 images.append(image)
 
-        LOG.debug("images of type '%s': %s", os_type, images)
+        LOG.debug("images of type '%s': %s", os_type, Summary(images))
 
         return images
 
@@ -397,6 +417,7 @@ class ConnectorMixin(object):
 
     @log_exception
     def configure_storage_quotas(self, project_id, quotas):
+        from cinderclient.exceptions import BadRequest as CinderBadRequest
         current_quotas = self.cinder_client.quotas.get(project_id)
         gigabytes_quotas = {key: 0 for key in current_quotas.to_dict().keys()
                             if key.startswith('gigabytes_')}
@@ -6,9 +6,11 @@
 from .hardware import CPU, RAM, Storage
 from .software import K8saas, LoadBalancer, WinVM
 from .traffic import FloatingIP, OutgoingTraffic
-from .base import Zero
+from .base import ConsumptionError, Zero, share_measures
+from .prefetch import GroupedMeasures
 
 __all__ = [
+    'ConsumptionError',
     'Zero',
     'CPU',
     'RAM',
@@ -17,5 +19,7 @@ __all__ = [
     'LoadBalancer',
     'K8saas',
     'WinVM',
-    'OutgoingTraffic'
+    'OutgoingTraffic',
+    'GroupedMeasures',
+    'share_measures'
 ]
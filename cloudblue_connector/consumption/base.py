@@ -3,10 +3,48 @@
 # This source code is distributed under MIT software license.
 # ******************************************************************************
 
-from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
+import threading
+
+from connect.config import Config
 
 from cloudblue_connector.connector import ConnectorMixin
 from cloudblue_connector.core import getLogger
+from cloudblue_connector.consumption.cache import fetch_aggregates
+from cloudblue_connector.consumption.measures import hourly_sum, hourly_average
+
+
+AGGREGATIONS = {
+    'sum': sum,
+    'count': len,
+}
+
+
+class ConsumptionError(Exception):
+    pass
+
+
+def aggregate_measures(series, aggregation):
+    """Aggregate measures of several resources the same way as Gnocchi `aggregate` operation
+
+    Values with the same granularity and timestamp are aggregated, coarse
+    granularity goes first and measures of each granularity are sorted by time.
+    As with the default `dropna` fill, every timestamp measured for at least
+    one resource is aggregated over the resources measured at it.
+    """
+
+    series = [measures for measures in series if measures]
+    if aggregation == 'sum' and len(series) == 1:
+        # the sum over a single resource is its measures, Gnocchi orders them the same way
+        return series[0]
+    points = {}
+    for measures in series:
+        for timestamp, granularity, value in measures:
+            points.setdefault((granularity, timestamp), []).append(value)
+
+    return [
+        (timestamp, granularity, AGGREGATIONS[aggregation](values))
+        for (granularity, timestamp), values in sorted(points.items(), key=lambda p: (-p[0][0], p[0][1]))
+    ]
 
 
 class Consumption(ConnectorMixin):
@@ -16,46 +54,109 @@ class Consumption(ConnectorMixin):
         self.logger = getLogger(self.__class__.__name__)
 
 
+class SharedMeasures(ConnectorMixin):
+    """Measures of several metrics of one resource type fetched with one request"""
+
+    def __init__(self, resource_type, metrics, granularity=None):
+        self.resource_type = resource_type
+        self.metrics = metrics
+        self.granularity = granularity
+        self._lock = threading.Lock()
+        self._measures = {}
+
+    @property
+    def operation(self):
+        return '(metric {})'.format(' '.join('({} mean)'.format(m) for m in self.metrics))
+
+    def get(self, metric, project, start_time, end_time):
+        """Return measures of the metric per resource of the project"""
+
+        from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
+        key = (project.id, start_time, end_time)
+        # collectors may run concurrently, only the first one makes the request
+        with self._lock:
+            if key not in self._measures:
+                try:
+                    self._measures[key] = fetch_aggregates(
+                        self.gnocchi_client, operations=self.operation, resource_type=self.resource_type,
+                        search="project_id={}".format(project.id),
+                        start=start_time, stop=end_time, granularity=self.granularity
+                    ).get('measures', {})
+                except GnocchiBadRequest:
+                    # means metric NotFound
+                    self._measures[key] = {}
+
+        return [resource.get(metric, {}).get('mean', []) for resource in self._measures[key].values()]
+
+
+def share_measures(consumptions):
+    """Let aggregated consumption collectors of the same resource type and granularity share one request"""
+
+    collectors = {}
+    for consumption in consumptions:
+        if isinstance(consumption, AggregatedConsumption):
+            collectors.setdefault((consumption.resource_type, consumption.granularity), []).append(consumption)
+
+    for (resource_type, granularity), group in collectors.items():
+        if len(group) < 2:
+            continue
+        shared = SharedMeasures(resource_type, [c.metric for c in group], granularity)
+        for consumption in group:
+            consumption.shared = shared
+
+
 class AggregatedConsumption(Consumption):
     resource_type = None
-    operation = None
+    metric = None
+    aggregation = None
     # by default, only hourly measures are considered
     hourly = True
     rate = 1
+    # granularity of requested measures in seconds, all granularities by default
+    granularity = None
+
+    def __init__(self, prefetched=None):
+        super(AggregatedConsumption, self).__init__()
+        granularities = Config.get_instance().misc.get('gnocchiGranularity') or {}
+        self.granularity = granularities.get(self.__class__.__name__, self.granularity)
+        # GroupedMeasures of all projects for the report window
+        self.prefetched = prefetched
+        # SharedMeasures of the project resources, see share_measures
+        self.shared = None
+
+    @property
+    def operation(self):
+        return '(aggregate {} (metric {} mean))'.format(self.aggregation, self.metric)
 
     def collect_consumption(self, project, start_time, end_time):
-        try:
-            measures = self.gnocchi_client.aggregates.fetch(
-                operations=self.operation, resource_type=self.resource_type,
-                search="project_id={}".format(project.id),
-                start=start_time, stop=end_time
-            ).get('measures', {}).get('aggregated', [])
-        except GnocchiBadRequest:
-            # means metric NotFound
-            measures = []
+        from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
+        measures = None
+        if self.prefetched is not None:
+            measures = self.prefetched.get(self, project.id, start_time, end_time)
+
+        if measures is None and self.shared is not None:
+            measures = aggregate_measures(
+                self.shared.get(self.metric, project, start_time, end_time), self.aggregation)
+
+        if measures is None:
+            try:
+                measures = fetch_aggregates(
+                    self.gnocchi_client, operations=self.operation, resource_type=self.resource_type,
+                    search="project_id={}".format(project.id),
+                    start=start_time, stop=end_time, granularity=self.granularity
+                ).get('measures', {}).get('aggregated', [])
+            except GnocchiBadRequest:
+                # means metric NotFound
+                measures = []
 
         return self.get_value(measures)
 
     def get_value(self, measures):
-        hours = 1
         if self.hourly:
             # full value is only every hour
-            measures = [m for m in measures if m[0].minute == 0]
-        else:
-            measures = [m for m in measures]
-            hours = max(
-                len([m for m in measures if m[0].minute == 0]),
-                hours
-            )
-
-        values = [m[-1] for m in measures]
-        if not values:
-            values = [0]
-
-        if self.hourly:
-            return int(sum(values) / self.rate)
+            return int(hourly_sum(measures) / self.rate)
         else:
-            return int(((float(sum(values)) / len(values)) * hours) / self.rate)
+            return int(hourly_average(measures) / self.rate)
 
 
 class Zero(Consumption):
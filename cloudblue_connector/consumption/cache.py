@@ -0,0 +1,222 @@
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+
+import contextvars
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytz
+from connect.config import Config
+from dateutil.parser import isoparse
+
+from cloudblue_connector.core import getLogger
+from cloudblue_connector.core.logger import phase
+
+
+class MeasuresCache(object):
+    """SQLite cache of Gnocchi aggregates responses of closed windows"""
+
+    # measures are processed by Gnocchi asynchronously, recent windows may be incomplete
+    settle_time = timedelta(hours=1)
+
+    def __init__(self, path, max_size, max_age):
+        self.logger = getLogger(self.__class__.__name__)
+        self.path = path
+        # total size of cached responses in bytes
+        self.max_size = max_size
+        # age of cached responses in seconds
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS measures '
+                '(key TEXT PRIMARY KEY, created REAL NOT NULL, size INTEGER NOT NULL, response BLOB NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS measures_created ON measures (created)')
+            # total size of cached responses, kept by put and evict, so the table is walked only over the limit
+            self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM measures').fetchone()[0]
+
+    @staticmethod
+    def key(**kwargs):
+        return json.dumps(kwargs, sort_keys=True, default=str)
+
+    def is_closed(self, stop):
+        return stop is not None and stop + self.settle_time <= datetime.utcnow()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT response FROM measures WHERE key = ? AND created > ?',
+                (key, time.time() - self.max_age)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def put(self, key, response):
+        data = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._db:
+            replaced = self._db.execute('SELECT size FROM measures WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO measures VALUES (?, ?, ?, ?)',
+                             (key, time.time(), len(data), sqlite3.Binary(data)))
+            self._size += len(data) - (replaced[0] if replaced else 0)
+            self.evict()
+
+    def evict(self):
+        """Remove expired responses and the oldest ones exceeding the size limit"""
+
+        created = time.time() - self.max_age
+        expired = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM measures WHERE created <= ?', (created,)).fetchone()
+        if expired[0]:
+            self._db.execute('DELETE FROM measures WHERE created <= ?', (created,))
+            self._size -= expired[1]
+
+        evicted = []
+        if self._size > self.max_size:
+            for key, key_size in self._db.execute('SELECT key, size FROM measures ORDER BY created'):
+                if self._size <= self.max_size:
+                    break
+                evicted.append((key,))
+                self._size -= key_size
+            self._db.executemany('DELETE FROM measures WHERE key = ?', evicted)
+        if expired[0] or evicted:
+            self.logger.debug("Evicted %s cached responses", expired[0] + len(evicted))
+
+
+def _naive_utc(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = isoparse(timestamp)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def slice_measures(response, start, stop):
+    """Return the response with measures from start to stop only, the same way Gnocchi selects them
+
+    Start is rounded down to granularity of measures, stop is not included.
+    """
+
+    if isinstance(response, dict):
+        return {key: slice_measures(value, start, stop) for key, value in response.items()}
+    if isinstance(response, list):
+        if response and isinstance(response[0], (list, tuple)) and len(response[0]) == 3:
+            start_seconds = (start - datetime(1970, 1, 1)).total_seconds()
+            return [
+                m for m in response
+                if start - timedelta(seconds=start_seconds % m[1]) <= _naive_utc(m[0]) < stop
+            ]
+        return [slice_measures(item, start, stop) for item in response]
+    return response
+
+
+class CatchUpWindow(object):
+    """Window of several report days, measures are fetched once for the window and sliced per day"""
+
+    # operations which results depend on the requested window
+    window_operations = ('rateofchange', 'rolling', 'resample')
+    # requests may stop a bit after the window, e.g. traffic requests
+    stop_margin = timedelta(hours=1)
+
+    def __init__(self, start, stop):
+        self.start = _naive_utc(start)
+        self.stop = _naive_utc(stop) + self.stop_margin
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._responses = {}
+
+    def covers(self, operations, start, stop):
+        return start is not None and stop is not None \
+            and self.start <= _naive_utc(start) and _naive_utc(stop) <= self.stop \
+            and not any(operation in str(operations) for operation in self.window_operations)
+
+    def fetch(self, gnocchi_client, kwargs):
+        key = MeasuresCache.key(**dict(kwargs, start=None, stop=None))
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        # concurrent collectors wait for the same response
+        with lock:
+            if key not in self._responses:
+                self._responses[key] = _fetch(gnocchi_client, dict(kwargs, start=self.start, stop=self.stop))
+        response = self._responses[key]
+        if response is None:
+            return None
+        return slice_measures(response, _naive_utc(kwargs['start']), _naive_utc(kwargs['stop']))
+
+
+_catch_up_window = contextvars.ContextVar('catch_up_window', default=None)
+
+
+@contextmanager
+def catch_up_window(start, stop):
+    """Fetch measures requested within the window once for the whole window"""
+
+    token = _catch_up_window.set(CatchUpWindow(start, stop))
+    try:
+        yield
+    finally:
+        _catch_up_window.reset(token)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache():
+    """Return cache configured with gnocchiCachePath or None if it is disabled"""
+
+    misc = Config.get_instance().misc
+    path = misc.get('gnocchiCachePath')
+    if not path:
+        return None
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = MeasuresCache(
+                path,
+                int(misc.get('gnocchiCacheMaxSize') or 100) * 1024 * 1024,
+                int(misc.get('gnocchiCacheMaxAge') or 7) * 24 * 60 * 60)
+    return _caches[path]
+
+
+def fetch_aggregates(gnocchi_client, operations, resource_type='generic', search=None, start=None, stop=None,
+                     granularity=None, groupby=None, fill=None):
+    """Fetch aggregates from Gnocchi
+
+    Responses of closed windows are cached if the cache is enabled,
+    within catch up window measures are fetched for the whole window.
+    """
+
+    kwargs = dict(operations=operations, resource_type=resource_type, search=search, start=start, stop=stop,
+                  granularity=granularity, groupby=groupby, fill=fill)
+
+    window = _catch_up_window.get()
+    if window is not None and window.covers(operations, start, stop):
+        return window.fetch(gnocchi_client, kwargs)
+    return _fetch(gnocchi_client, kwargs)
+
+
+def _fetch(gnocchi_client, kwargs):
+    stop = kwargs['stop']
+    cache = get_cache()
+    if cache is None or not cache.is_closed(stop):
+        with phase('gnocchi'):
+            return gnocchi_client.aggregates.fetch(**kwargs)
+
+    key = cache.key(**kwargs)
+    response = cache.get(key)
+    if response is None:
+        with phase('gnocchi'):
+            response = gnocchi_client.aggregates.fetch(**kwargs)
+        if response is not None:
+            cache.put(key, response)
+    return response
@@ -3,19 +3,21 @@
 # This source code is distributed under MIT software license.
 # ******************************************************************************
 
-from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
-
-from cloudblue_connector.consumption.base import Consumption, AggregatedConsumption
+from cloudblue_connector.consumption.base import Consumption, AggregatedConsumption, aggregate_measures
+from cloudblue_connector.consumption.cache import fetch_aggregates
+from cloudblue_connector.consumption.measures import hourly_average
 
 
 class CPU(AggregatedConsumption):
     resource_type = 'instance'
-    operation = '(aggregate sum (metric vcpus mean))'
+    metric = 'vcpus'
+    aggregation = 'sum'
 
 
 class RAM(AggregatedConsumption):
     resource_type = 'instance'
-    operation = '(aggregate sum (metric memory mean))'
+    metric = 'memory'
+    aggregation = 'sum'
     rate = 1024
 
 
@@ -23,43 +25,28 @@ class Storage(Consumption):
     resource_name = 'volume.'
 
     def collect_consumption(self, project, start_time, end_time):
-        metrics = {
-            'resource_name1': self.resource_name + 'size',
-            'resource_name2': self.resource_name + 'snapshot.size',
-        }
-
-        try:
-            measures1 = self.gnocchi_client.aggregates.fetch(
-                operations='(aggregate sum (metric {} mean))'.format(metrics.get('resource_name1')),
-                resource_type='volume',
-                search="project_id={}".format(project.id),
-                start=start_time, stop=end_time
-            ).get('measures', {}).get('aggregated', [])
-        except GnocchiBadRequest:
-            # means metric NotFound
-            measures1 = []
-
+        from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
+        metrics = [
+            self.resource_name + 'size',
+            self.resource_name + 'snapshot.size',
+        ]
+
+        # both metrics are fetched per volume with one request, each of them is summed over volumes
+        # and averaged separately, so hours without snapshots still count volume sizes
         try:
-            measures2 = self.gnocchi_client.aggregates.fetch(
-                operations='(aggregate sum (metric {} mean))'.format(metrics.get('resource_name2')),
+            measures = fetch_aggregates(
+                self.gnocchi_client, operations='(metric {})'.format(' '.join('({} mean)'.format(m) for m in metrics)),
                 resource_type='volume',
                 search="project_id={}".format(project.id),
                 start=start_time, stop=end_time
-            ).get('measures', {}).get('aggregated', [])
+            ).get('measures', {})
         except GnocchiBadRequest:
             # means metric NotFound
-            measures2 = []
+            measures = {}
 
         result = 0
-        for measures in (measures1, measures2):
-            hours = max(
-                len([m for m in measures if m[0].minute == 0]),
-                1
-            )
-            values = [m[-1] for m in measures]
-            if not values:
-                values = [0]
-
-            result += (float(sum(values)) / len(values)) * hours
+        for metric in metrics:
+            result += hourly_average(aggregate_measures(
+                [volume.get(metric, {}).get('mean', []) for volume in measures.values()], 'sum'))
 
         return int(result)
@@ -0,0 +1,36 @@
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+
+# Reducers take Gnocchi measures as they are returned, lists of [timestamp, granularity, value],
+# and go over them once without building intermediate lists or converting timestamps.
+
+
+def hourly_sum(measures):
+    """Sum of values measured at whole hours"""
+
+    return sum(m[-1] for m in measures if m[0].minute == 0)
+
+
+def hourly_average(measures):
+    """Average value multiplied by the number of whole hours measured, at least one"""
+
+    if not measures:
+        return 0.0
+    hours = max(sum(1 for m in measures if m[0].minute == 0), 1)
+    return (float(sum(m[-1] for m in measures)) / len(measures)) * hours
+
+
+def positive_delta_sum(measures):
+    """Sum of increases of a cumulative counter, decreases are counter resets"""
+
+    result = 0.0
+    if measures:
+        previous_value = measures[0][-1]
+        for m in measures:
+            value = m[-1]
+            if previous_value < value:
+                result += value - previous_value
+            previous_value = value
+    return result
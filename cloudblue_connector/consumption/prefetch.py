@@ -0,0 +1,55 @@
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+
+from cloudblue_connector.connector import ConnectorMixin
+from cloudblue_connector.core import getLogger
+from cloudblue_connector.consumption.cache import fetch_aggregates
+
+
+class GroupedMeasures(ConnectorMixin):
+    """Measures of all projects fetched with one groupby request per collector"""
+
+    def __init__(self, start_time, end_time):
+        self.logger = getLogger(self.__class__.__name__)
+        self.start_time = start_time
+        self.end_time = end_time
+        self._measures = {}
+
+    @staticmethod
+    def _key(consumption):
+        return consumption.resource_type, consumption.operation, consumption.granularity
+
+    def prefetch(self, consumption):
+        """Fetch measures of the aggregated consumption collector for all projects"""
+
+        try:
+            groups = fetch_aggregates(
+                self.gnocchi_client, operations=consumption.operation, resource_type=consumption.resource_type,
+                search="project_id!=null", groupby=['project_id'],
+                start=self.start_time, stop=self.end_time, granularity=consumption.granularity
+            )
+        except Exception:
+            # collector falls back to per project requests
+            self.logger.exception("Unable to prefetch '%s' measures of '%s' resources",
+                                  consumption.operation, consumption.resource_type)
+            return
+
+        self._measures[self._key(consumption)] = {
+            group['group']['project_id']: group['measures']['measures'].get('aggregated', [])
+            for group in groups
+        }
+        self.logger.info("Prefetched '%s' measures of %s projects",
+                         consumption.operation, len(self._measures[self._key(consumption)]))
+
+    def get(self, consumption, project_id, start_time, end_time):
+        """Return prefetched measures of the project or None if they were not prefetched"""
+
+        if (start_time, end_time) != (self.start_time, self.end_time):
+            return None
+        measures = self._measures.get(self._key(consumption))
+        if measures is None:
+            return None
+        # project without resources has no group
+        return measures.get(project_id, [])
@@ -3,28 +3,57 @@
 # This source code is distributed under MIT software license.
 # ******************************************************************************
 
+import json
 from math import ceil
 
 import pytz
 from dateutil.parser import isoparse
 from dateutil.relativedelta import relativedelta
-from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
 
 from cloudblue_connector.consumption.base import Consumption, AggregatedConsumption
+from cloudblue_connector.consumption.cache import fetch_aggregates
+from cloudblue_connector.core.logger import phase
 
 
 class LoadBalancer(AggregatedConsumption):
     resource_type = 'loadbalancer'
-    operation = '(aggregate count (metric network.services.lb.loadbalancer mean))'
+    metric = 'network.services.lb.loadbalancer'
+    aggregation = 'count'
     hourly = False
 
 
 class K8saas(AggregatedConsumption):
     resource_type = 'coe_cluster'
-    operation = '(aggregate count (metric magnum.cluster mean))'
+    metric = 'magnum.cluster'
+    aggregation = 'count'
 
 
 class WinVM(Consumption):
+    # number of instance ids in one search query
+    chunk_size = 100
+
+    def get_vcpus_measures(self, instance_ids, start_time, end_time):
+        """Return vcpus measures by instance id, fetched with grouped requests"""
+
+        from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest, NotFound as GnocchiNotFound
+        measures = {}
+        for i in range(0, len(instance_ids), self.chunk_size):
+            try:
+                groups = fetch_aggregates(
+                    self.gnocchi_client, operations="(aggregate sum (metric vcpus mean))",
+                    resource_type="instance", search="id in {}".format(json.dumps(instance_ids[i:i + self.chunk_size])),
+                    groupby=['id'], start=start_time, stop=end_time
+                )
+            except (GnocchiBadRequest, GnocchiNotFound):
+                # means metric NotFound
+                continue
+            # instance without metric has no group
+            measures.update({
+                group['group']['id']: group['measures']['measures'].get('aggregated', [])
+                for group in groups
+            })
+        return measures
+
     def collect_consumption(self, project, start_time, end_time):
 
         def calculate_rounded_period(created, deleted):
@@ -43,16 +72,17 @@ class WinVM(Consumption):
         marker = None
         page_limit = 100
         while True:
-            page = self.gnocchi_client.resource.search(
-                resource_type='instance',
-                query="project_id={} and ({}) and ({})".format(
-                    project.id,
-                    " or ".join("image_ref=" + img.get('id') for img in images_list),
-                    'deleted_at=null or (deleted_at>"' + start_time.isoformat() + '")'
-                ),
-                limit=page_limit,
-                marker=marker
-            )
+            with phase('gnocchi'):
+                page = self.gnocchi_client.resource.search(
+                    resource_type='instance',
+                    query="project_id={} and ({}) and ({})".format(
+                        project.id,
+                        " or ".join("image_ref=" + img.get('id') for img in images_list),
+                        'deleted_at=null or (deleted_at>"' + start_time.isoformat() + '")'
+                    ),
+                    limit=page_limit,
+                    marker=marker
+                )
             instances.extend(page)
             if len(page) == page_limit:
                 marker = page[-1].get('id')
@@ -61,7 +91,7 @@ class WinVM(Consumption):
 
         start_time_aware = pytz.timezone(pytz.utc.zone).localize(start_time)
         end_time_aware = pytz.timezone(pytz.utc.zone).localize(end_time)
-        vm_count = 0
+        periods = []
         for instance in instances:
             created_at = isoparse(instance.get('created_at'))
             deleted_at = isoparse(instance.get('deleted_at')) if instance.get('deleted_at') else end_time_aware
@@ -75,24 +105,18 @@ class WinVM(Consumption):
             if created_at >= end_time_aware:
                 # VM not created yet or already deleted
                 continue
-            else:
-                period_round = calculate_rounded_period(created_at, deleted_at)
-
-                try:
-                    measures = self.gnocchi_client.aggregates.fetch(
-                        operations="(aggregate sum (metric vcpus mean))",
-                        resource_type="instance", search="id={}".format(instance.get('id')),
-                        start=start_time, stop=end_time
-                    ).get('measures', {}).get('aggregated', [])
-                except GnocchiBadRequest:
-                    # means metric NotFound
-                    measures = []
-                values = [m[-1] for m in measures] or [1]
-                vcpus_average = sum(values) / len(values)
-
-                self.logger.debug("VM usage=%s, vcpus average: %s for: %s '%s'", period_round, vcpus_average,
-                                  instance.get('id'), instance.get('display_name'))
-
-                vm_count += ceil(period_round * vcpus_average)
+            periods.append((instance, calculate_rounded_period(created_at, deleted_at)))
+
+        vcpus = self.get_vcpus_measures([instance.get('id') for instance, _ in periods], start_time, end_time)
+
+        vm_count = 0
+        for instance, period_round in periods:
+            values = [m[-1] for m in vcpus.get(instance.get('id'), [])] or [1]
+            vcpus_average = sum(values) / len(values)
+
+            self.logger.debug("VM usage=%s, vcpus average: %s for: %s '%s'", period_round, vcpus_average,
+                              instance.get('id'), instance.get('display_name'))
+
+            vm_count += ceil(period_round * vcpus_average)
 
         return vm_count
@@ -3,76 +3,139 @@
 # This source code is distributed under MIT software license.
 # ******************************************************************************
 
+import json
 from datetime import timedelta
 
-from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
+from connect.config import Config
 
 from cloudblue_connector.consumption.base import Consumption, AggregatedConsumption
+from cloudblue_connector.consumption.cache import fetch_aggregates
+from cloudblue_connector.consumption.measures import positive_delta_sum
+from cloudblue_connector.core.logger import Sampler, Summary, phase
 
 
 class FloatingIP(AggregatedConsumption):
     resource_type = 'network'
-    operation = '(aggregate count (metric ip.floating mean))'
+    metric = 'ip.floating'
+    aggregation = 'count'
     hourly = False
 
 
 class OutgoingTraffic(Consumption):
-    def collect_consumption(self, project, start_time, end_time):
-        instances = []
+    page_limit = 100
+    # number of resource ids in one search query
+    chunk_size = 100
+    rate_operation = '(aggregate sum (clip_min (rateofchange (metric network.outgoing.bytes mean)) 0))'
+
+    def __init__(self):
+        super(OutgoingTraffic, self).__init__()
+        granularities = Config.get_instance().misc.get('gnocchiGranularity') or {}
+        # granularity of requested measures in seconds, all granularities by default
+        self.granularity = granularities.get(self.__class__.__name__)
+
+    def search_resources(self, resource_type, query):
+        """Search resources page by page"""
+
+        resources = []
         marker = None
-        page_limit = 100
         while True:
-            page = self.gnocchi_client.resource.search(
-                resource_type='instance',
-                query="project_id={} and ({})".format(
-                    project.id,
-                    'deleted_at=null or (deleted_at>"' + start_time.isoformat() + '")'),
-                limit=page_limit,
-                marker=marker
-            )
-            instances.extend(page)
-            if len(page) == page_limit:
+            with phase('gnocchi'):
+                page = self.gnocchi_client.resource.search(
+                    resource_type=resource_type,
+                    query=query,
+                    limit=self.page_limit,
+                    marker=marker
+                )
+            resources.extend(page)
+            if len(page) == self.page_limit:
                 marker = page[-1].get('id')
             else:
                 break
-        self.logger.info("Instances: %s", instances)
+        return resources
+
+    def chunks(self, ids):
+        for i in range(0, len(ids), self.chunk_size):
+            yield ids[i:i + self.chunk_size]
+
+    def sum_deltas(self, interfaces, start_time, end_time):
+        """Sum positive deltas of cumulative counters of the interfaces"""
+
+        from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
+        measures = {}
+        for ids in self.chunks([interface.get('id') for interface in interfaces]):
+            try:
+                # for traffic we need to get wholeday stats, starting and ending in midnight
+                measures.update(fetch_aggregates(
+                    self.gnocchi_client, operations="(metric network.outgoing.bytes mean)",
+                    resource_type="generic", search="id in {}".format(json.dumps(ids)),
+                    start=start_time, stop=end_time + timedelta(minutes=5), granularity=self.granularity
+                ).get('measures', {}))
+            except GnocchiBadRequest:
+                # means metric NotFound
+                pass
 
         bytes_out = 0.0
-        for instance in instances:
-            interfaces = []
-            page = self.gnocchi_client.resource.search(
-                resource_type='instance_network_interface',
-                query="instance_id={}".format(instance.get('id')),
-                limit=page_limit,
-                marker=None
-            )
-            interfaces.extend(page)
-            self.logger.info("Instance id='%s', name='%s' interfaces: %s",
-                             instance.get('id'), instance.get('display_name'), interfaces)
-
-            for interface in interfaces:
-                try:
-                    # for traffic we need to get wholeday stats, starting and ending in midnight
-                    measures = self.gnocchi_client.aggregates.fetch(
-                        operations="(metric network.outgoing.bytes mean)",
-                        resource_type="generic", search="id={}".format(interface.get('id')),
-                        start=start_time, stop=end_time + timedelta(minutes=5)
-                    ).get('measures', {}).get(interface.get('id'), {}).get('network.outgoing.bytes', {}).get('mean', [])
-                except GnocchiBadRequest:
-                    # means metric NotFound
-                    measures = []
-
-                bytes_out_if = 0.0
-                if len(measures):
-                    previous_value = measures[0][2]
-                    for m in measures:
-                        if previous_value < m[2]:
-                            bytes_out_if += m[2] - previous_value
-                        previous_value = m[2]
-
-                self.logger.info("Outgoing traffic for instance id='%s' on interface id='%s' name='%s': %sB",
-                                 instance.get('id'), interface.get('id'), interface.get('name'), bytes_out_if)
-                bytes_out += bytes_out_if
+        sampled = Sampler(Config.get_instance().misc.get('logSampleRate', 1.0))
+        for interface in interfaces:
+            interface_measures = measures.get(interface.get('id'), {}).get('network.outgoing.bytes', {}).get('mean', [])
+
+            bytes_out_if = positive_delta_sum(interface_measures)
+
+            if sampled():
+                self.logger.debug("Outgoing traffic for instance id='%s' on interface id='%s' name='%s': %sB",
+                                  interface.get('instance_id'), interface.get('id'), interface.get('name'),
+                                  bytes_out_if)
+            bytes_out += bytes_out_if
+        return bytes_out
+
+    def sum_rates(self, interfaces, start_time, end_time):
+        """Sum deltas of cumulative counters of the interfaces computed by Gnocchi"""
+
+        from gnocchiclient.exceptions import BadRequest as GnocchiBadRequest
+        bytes_out = 0.0
+        for ids in self.chunks([interface.get('id') for interface in interfaces]):
+            try:
+                # gaps are forward filled and counter resets are clipped to zero,
+                # so the sum is the same as the sum of positive deltas
+                measures = fetch_aggregates(
+                    self.gnocchi_client, operations=self.rate_operation,
+                    resource_type="generic", search="id in {}".format(json.dumps(ids)),
+                    start=start_time, stop=end_time + timedelta(minutes=5), granularity=self.granularity,
+                    fill='ffill'
+                ).get('measures', {}).get('aggregated', [])
+            except GnocchiBadRequest:
+                # means metric NotFound
+                measures = []
+
+            if measures:
+                # without configured granularity deltas of every granularity of the archive
+                # policy are returned, each of them sums up to the traffic, the finest one is used
+                granularity = min(m[1] for m in measures)
+                bytes_out_chunk = sum(m[2] for m in measures if m[1] == granularity)
+                self.logger.info("Outgoing traffic on interfaces %s: %sB", Summary(ids), bytes_out_chunk)
+                bytes_out += bytes_out_chunk
+        return bytes_out
+
+    def collect_consumption(self, project, start_time, end_time):
+        instances = self.search_resources(
+            'instance',
+            "project_id={} and ({})".format(
+                project.id,
+                'deleted_at=null or (deleted_at>"' + start_time.isoformat() + '")')
+        )
+        self.logger.info("Instances: %s", Summary(instances))
+
+        # network interfaces of all instances are searched in bulk
+        interfaces = []
+        for ids in self.chunks([instance.get('id') for instance in instances]):
+            interfaces.extend(self.search_resources(
+                'instance_network_interface', "instance_id in {}".format(json.dumps(ids))))
+        self.logger.info("Interfaces: %s", Summary(interfaces))
+
+        if Config.get_instance().misc.get('trafficRateAggregation'):
+            bytes_out = self.sum_rates(interfaces, start_time, end_time)
+        else:
+            bytes_out = self.sum_deltas(interfaces, start_time, end_time)
 
         # convert to MB
         bytes_out = round(bytes_out / (1024 * 1024), 4)
@@ -4,6 +4,9 @@
 # ******************************************************************************
 import functools
 import logging
+import threading
+import time
+from collections import OrderedDict
 
 LOG = logging.getLogger("decorators")
 
@@ -23,24 +26,103 @@ def once(f):
     return wrapper
 
 
-def memoize(f):
-    """Cache result of a function call with parameters"""
-    f.memory = {}
+class Cache(object):
+    """Results of function calls bounded by time to live and size, least recently used are evicted first"""
 
-    @functools.wraps(f)
-    def wrapper(self, *args, **kwargs):
-        x = None
-        try:
-            x = tuple(list(args) + [])
-        except TypeError:
-            LOG.exception('XXX')
-        rv = f.memory.get(x, MISSING)
-        if rv is MISSING:
-            rv = f(self, *args, **kwargs)
-            f.memory[x] = rv
-        return rv
+    def __init__(self, name, ttl=None, maxsize=None):
+        self.name = name
+        # seconds to keep a result, forever if None
+        self.ttl = ttl
+        # number of results to keep, unlimited if None
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
 
-    return wrapper
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is not MISSING and self.ttl is not None and item[0] + self.ttl <= time.monotonic():
+                del self._data[key]
+                self.evictions += 1
+                item = MISSING
+            if item is MISSING:
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while self.maxsize is not None and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=MISSING):
+        """Remove the result of the key or all results"""
+
+        with self._lock:
+            if key is MISSING:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._data)}
+
+
+_caches = []
+
+
+def cached(ttl=None, maxsize=None):
+    """Cache results of a method call with parameters
+
+    Results are shared by all instances, they depend on parameters only.
+    Use `method.invalidate(*args, **kwargs)` to remove a result, `method.cache` to inspect counters.
+    """
+
+    def decorator(f):
+        cache = Cache(f.__qualname__, ttl, maxsize)
+        _caches.append(cache)
+
+        def make_key(args, kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            hash(key)
+            return key
+
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            try:
+                key = make_key(args, kwargs)
+            except TypeError:
+                LOG.warning("Unable to cache %s call with unhashable arguments", cache.name)
+                return f(self, *args, **kwargs)
+            rv = cache.get(key)
+            if rv is MISSING:
+                rv = f(self, *args, **kwargs)
+                cache.put(key, rv)
+            return rv
+
+        wrapper.cache = cache
+        wrapper.invalidate = lambda *args, **kwargs: cache.invalidate(make_key(args, kwargs))
+        return wrapper
+
+    return decorator
+
+
+def log_cache_stats(logger=LOG):
+    """Log hit, miss and eviction counters of all caches"""
+
+    for cache in _caches:
+        stats = cache.stats()
+        if stats['hits'] or stats['misses']:
+            logger.info("Cache %s: %s hits, %s misses, %s evictions, %s results",
+                        cache.name, stats['hits'], stats['misses'], stats['evictions'], stats['size'])
 
 
 def log_exception(f):
@@ -0,0 +1,71 @@
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+import functools
+import threading
+import time
+from collections import Counter, deque, namedtuple
+
+from connect.config import Config
+
+Entry = namedtuple('Entry', ('request_id', 'outcome', 'duration'))
+
+
+class History(object):
+    """Bounded history of processed requests for debug
+
+    Only the last `historySize` requests are kept, totals are counted for all of them.
+    """
+
+    def __init__(self, size=None):
+        if size is None:
+            size = Config.get_instance().misc.get('historySize')
+            size = 100 if size is None else size
+        self.entries = deque(maxlen=int(size))
+        self.outcomes = Counter()
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def record(self, request_id, outcome, duration):
+        with self._lock:
+            self.entries.append(Entry(request_id, outcome, duration))
+            self.outcomes[outcome] += 1
+            self.duration += duration
+
+    def summary(self):
+        """Return compact summary of processed requests"""
+
+        with self._lock:
+            return {
+                'processed': sum(self.outcomes.values()),
+                'outcomes': dict(self.outcomes),
+                'duration': round(self.duration, 3),
+            }
+
+
+def tracked(f):
+    """Record request id, outcome and duration of request processing in `self.history`
+
+    Outcome is the name of a raised exception, e.g. SkipRequest, or 'done'.
+    """
+
+    @functools.wraps(f)
+    def wrapper(self, request, *args, **kwargs):
+        outcome = 'done'
+        started = time.monotonic()
+        try:
+            return f(self, request, *args, **kwargs)
+        except BaseException as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            self.history.record(getattr(request, 'id', None), outcome, time.monotonic() - started)
+
+    return wrapper
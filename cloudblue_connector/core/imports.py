@@ -0,0 +1,32 @@
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+import importlib
+
+
+class LazyClass(object):
+    """Class imported from its module on first call or attribute access
+
+    Client libraries are heavy to import and not all of them are used by each application.
+    Exceptions can't be lazy, `except` clauses need real classes, import them where they are caught.
+    """
+
+    def __init__(self, module, name):
+        self._module = module
+        self._name = name
+        self._class = None
+
+    def resolve(self):
+        if self._class is None:
+            self._class = getattr(importlib.import_module(self._module), self._name)
+        return self._class
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __repr__(self):
+        return '<lazy {}.{}>'.format(self._module, self._name)
@@ -3,41 +3,184 @@
 # This source code is distributed under MIT software license.
 # ******************************************************************************
 
+import atexit
+import contextvars
+import inspect
 import json
 import logging
 import os
+import queue
 import re
-import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from functools import wraps
+from itertools import count, islice
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
 
 from connect.config import Config
 from connect.logger import logger
+from connect.models import Asset
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Put records to a bounded queue, drop them or wait when the queue is full"""
+
+    def __init__(self, records, policy='block'):
+        super(BoundedQueueHandler, self).__init__(records)
+        if policy not in ('block', 'drop'):
+            raise ValueError('Unknown logging queue policy "{}"'.format(policy))
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        # handlers run on the listener thread, the context of the request is only known here
+        ContextFilter().filter(record)
+        return super(BoundedQueueHandler, self).prepare(record)
+
+    def enqueue(self, record):
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class FlushingQueueListener(QueueListener):
+    """Queue listener which handles all queued records on stop, even if the queue is full"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def enqueue_handlers(log=None, size=10000, policy='block'):
+    """Move handlers of the logger (root by default) to a background thread
+
+    Records are passed to the handlers through a bounded queue, queued records are handled on exit.
+    """
+
+    log = log or logging.getLogger()
+    handlers = list(log.handlers)
+    records = queue.Queue(maxsize=size)
+    handler = BoundedQueueHandler(records, policy)
+    listener = FlushingQueueListener(records, *handlers, respect_handler_level=True)
+    for h in handlers:
+        log.removeHandler(h)
+    log.addHandler(handler)
+    listener.start()
+
+    def flush():
+        atexit.unregister(flush)
+        listener.stop()
+        # records logged later are handled on the calling thread
+        log.removeHandler(handler)
+        for h in handlers:
+            log.addHandler(h)
+        if handler.dropped:
+            log.warning("%s log records were dropped, logging queue was full", handler.dropped)
+
+    atexit.register(flush)
+    return handler, listener, flush
 
-# Configure logging
-if os.path.exists('/etc/cloudblue-connector/config-logging.json'):
-    with open('/etc/cloudblue-connector/config-logging.json') as config_log_file:
-        settings = json.load(config_log_file)
-        dictConfig(settings['logging'])
 
 # Set connect log level / default level ERROR
 logger.setLevel('DEBUG')
 
-context_data = threading.local()
-context_data.request_id = None
+
+LogContext = namedtuple('LogContext', (
+    'request_id', 'asset_id', 'project_id',
+    # monotonic time the request processing started
+    'started',
+    # keystone, gnocchi or connect while waiting for the service, and monotonic time it started
+    'phase', 'phase_started',
+), defaults=(None,) * 6)
+
+# Context of the processed request, asyncio tasks inherit it,
+# worker threads get it with context_bound
+log_context = contextvars.ContextVar('log_context', default=LogContext())
+
+
+def set_context(**kwargs):
+    """Set logging context fields of the current request, e.g. project_id"""
+
+    log_context.set(log_context.get()._replace(**kwargs))
 
 
 class ContextFilter(logging.Filter):
     """
     This is a filter which injects contextual information into the log record.
+
+    Records get request_id, asset_id, project_id, phase and elapsed_ms attributes,
+    milliseconds since the phase or the request processing started.
     """
 
     def filter(self, record):
-        if context_data.request_id:
-            record.name += "." + context_data.request_id
+        if hasattr(record, 'request_id'):
+            # already set by the logger, handlers may run on another thread
+            return True
+        context = log_context.get()
+        record.request_id = context.request_id
+        record.asset_id = context.asset_id
+        record.project_id = context.project_id
+        record.phase = context.phase
+        if getattr(record, 'elapsed_ms', None) is None:
+            started = context.phase_started or context.started
+            record.elapsed_ms = round((time.monotonic() - started) * 1000, 1) if started else None
         return True
 
 
+class JsonFormatter(logging.Formatter):
+    """Format records as single line JSON objects with context fields"""
+
+    fields = ('request_id', 'asset_id', 'project_id', 'phase', 'elapsed_ms')
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'function': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        for field in self.fields:
+            data[field] = getattr(record, field, None)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def mask_values(text, values, mask='***hidden***'):
+    """Replace values in the text with the mask in a single pass
+
+    The result is the same as of `re.sub` with alternation of the escaped values:
+    text is scanned from left to right, the first listed value found at a position is replaced.
+    """
+
+    starts = {}
+    for value in values:
+        position = text.find(value)
+        while position != -1:
+            # earlier listed values win
+            starts.setdefault(position, value)
+            position = text.find(value, position + 1)
+
+    parts = []
+    end = 0
+    for position in sorted(starts):
+        if position < end:
+            continue
+        parts.append(text[end:position])
+        parts.append(mask)
+        end = position + len(starts[position])
+    parts.append(text[end:])
+    return ''.join(parts)
+
+
 class PasswordFilter(logging.Filter):
     """
     This is a filter which wipes password information from the log record.
@@ -45,6 +188,8 @@ class PasswordFilter(logging.Filter):
 
     is_enabled = None
 
+    # any message with password parameters contains it, checked before regular expressions
+    marker = '"password"'
     type_pattern = re.compile(r'"type":\s?"password"', re.MULTILINE)
     password_patterns = [
         re.compile(r'^Function\s`.*?`\sreturn:\s\(u?\'(.*)\',\s\d+\)$', re.MULTILINE + re.DOTALL),
@@ -53,12 +198,14 @@ class PasswordFilter(logging.Filter):
 
     def filter(self, record):
         def get_function_rv():
+            if not isinstance(record.msg, str) or PasswordFilter.marker not in record.msg:
+                return None
             if PasswordFilter.is_enabled is None:
                 PasswordFilter.is_enabled = Config.get_instance().misc['hidePasswordsInLog']
-            if PasswordFilter.is_enabled and re.search(PasswordFilter.type_pattern, record.msg):
+            if PasswordFilter.is_enabled and PasswordFilter.type_pattern.search(record.msg):
                 msg = record.msg.replace("\n", "\\n").replace("\\'", "'")
                 for pattern in PasswordFilter.password_patterns:
-                    match = re.search(pattern, msg)
+                    match = pattern.search(msg)
                     if match:
                         return match.group(1)
                 logger.warning("Message does not match against password patterns")
@@ -78,10 +225,9 @@ class PasswordFilter(logging.Filter):
                 for params in node.get('params', []), node.get('asset', {}).get('params', []):
                     for p in params:
                         if p.get('type', None) == 'password' and p.get('value', None):
-                            pwd = re.escape(p['value'])
-                            if pwd not in found_passwords:
-                                found_passwords[pwd] = ''
-            record.msg = re.sub("|".join(found_passwords.keys()), "***hidden***", record.msg, flags=re.M)
+                            found_passwords.setdefault(p['value'], None)
+            if found_passwords:
+                record.msg = mask_values(record.msg, found_passwords)
         except ValueError:
             logger.exception("Cannot deserialize API payload. Raw data: %s", raw_json)
         except Exception:
@@ -89,6 +235,54 @@ class PasswordFilter(logging.Filter):
         return True
 
 
+class Summary(object):
+    """Collection rendered in a log message as its size and the first ids
+
+    Rendering is lazy, the collection is not walked if the record is not emitted.
+    """
+
+    # ids rendered at most
+    max_ids = 10
+    # rendered length at most
+    max_length = 1000
+
+    def __init__(self, items, key=None, max_ids=None):
+        self.items = items
+        self.key = key or self.default_key
+        if max_ids is not None:
+            self.max_ids = max_ids
+
+    @staticmethod
+    def default_key(item):
+        if isinstance(item, dict):
+            return item.get('id')
+        return getattr(item, 'id', item)
+
+    def __str__(self):
+        items = self.items if hasattr(self.items, '__len__') else list(self.items)
+        ids = ', '.join(str(self.key(item)) for item in islice(items, self.max_ids))
+        rendered = '{} items [{}{}]'.format(len(items), ids, ', ...' if len(items) > self.max_ids else '')
+        if len(rendered) > self.max_length:
+            rendered = rendered[:self.max_length - 4] + ' ...'
+        return rendered
+
+    __repr__ = __str__
+
+
+class Sampler(object):
+    """Decide which of repeated per element log records are emitted, `rate` of them are"""
+
+    def __init__(self, rate=1.0):
+        # unset rate in the config means all records
+        rate = 1.0 if rate is None else float(rate)
+        self.every = max(int(round(1 / rate)), 1) if rate > 0 else 0
+        self._counter = count()
+
+    def __call__(self):
+        # the first record is always emitted
+        return self.every > 0 and next(self._counter) % self.every == 0
+
+
 def getLogger(name):
     log = logging.getLogger(name)
     log.setLevel('DEBUG')
@@ -96,18 +290,66 @@ def getLogger(name):
     return log
 
 
+def _request_context(request):
+    asset = request if isinstance(request, Asset) else getattr(request, 'asset', None)
+    return LogContext(request_id=request.id, asset_id=getattr(asset, 'id', None), started=time.monotonic())
+
+
 def context_log(func):
-    """Store and clean context for logging"""
+    """Set logging context of the processed request, the previous context is restored on return"""
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def coroutine_wrapper(self, request, *args, **kwargs):
+            token = log_context.set(_request_context(request))
+            try:
+                return await func(self, request, *args, **kwargs)
+            finally:
+                log_context.reset(token)
+        return coroutine_wrapper
 
     @wraps(func)
     def wrapper(self, request, *args, **kwargs):
-        context_data.request_id = request.id
-        result = func(self, request, *args, **kwargs)
-        context_data.request_id = None
-        return result
+        token = log_context.set(_request_context(request))
+        try:
+            return func(self, request, *args, **kwargs)
+        finally:
+            log_context.reset(token)
     return wrapper
 
 
+def context_bound(func):
+    """Run function with logging and context variables of the caller, e.g. in a worker thread"""
+
+    context = contextvars.copy_context()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # a context can not be entered by several threads at once
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+phase_logger = getLogger("Phase")
+
+
+@contextmanager
+def phase(name):
+    """Mark records logged while waiting for a service, e.g. keystone, gnocchi or connect
+
+    The end of the phase is logged with its duration in elapsed_ms.
+    """
+
+    started = time.monotonic()
+    token = log_context.set(log_context.get()._replace(phase=name, phase_started=started))
+    try:
+        yield
+    finally:
+        elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+        phase_logger.debug("Phase %s finished in %s ms", name, elapsed_ms, extra={'elapsed_ms': elapsed_ms})
+        log_context.reset(token)
+
+
 # Add context filter to external loggers
 ext_loggers = ["keystoneauth.session", "decorators"]
 for logger_name in ext_loggers:
@@ -117,3 +359,14 @@ for logger_name in ext_loggers:
 # Add filters to root logger
 logger.addFilter(ContextFilter())
 logger.addFilter(PasswordFilter())
+
+# Configure logging
+if os.path.exists('/etc/cloudblue-connector/config-logging.json'):
+    with open('/etc/cloudblue-connector/config-logging.json') as config_log_file:
+        settings = json.load(config_log_file)
+        dictConfig(settings['logging'])
+        # handlers write records on a background thread
+        queue_settings = settings.get('queue') or {}
+        if queue_settings.get('enabled'):
+            enqueue_handlers(size=int(queue_settings.get('size', 10000)),
+                             policy=queue_settings.get('policy', 'block'))
@@ -0,0 +1,77 @@
+# ******************************************************************************
+# Copyright (c) 2020-2021, Virtuozzo International GmbH.
+# This source code is distributed under MIT software license.
+# ******************************************************************************
+import signal
+import threading
+import time
+
+from cloudblue_connector import runners
+from cloudblue_connector.connector import ConnectorConfig
+from cloudblue_connector.core import getLogger
+
+LOG = getLogger("Daemon")
+
+
+class Job(object):
+    """Runner called repeatedly with its own interval"""
+
+    # seconds between the end of a run and the start of the next one,
+    # the same as RestartSec of one-shot services
+    default_interval = 30
+
+    def __init__(self, name, runner, report_usage):
+        self.name = name
+        self.runner = runner
+        # config is parsed once and kept for all runs
+        self.config = ConnectorConfig(file=runners.CONFIG_FILE, report_usage=report_usage)
+        intervals = self.config.misc.get('daemonIntervals') or {}
+        self.interval = float(intervals.get(name, self.default_interval))
+        self.next_run = time.monotonic()
+
+    def run(self):
+        started = time.monotonic()
+        try:
+            summary = self.runner(config=self.config)
+            LOG.info("Job %s finished in %.1f seconds: %s", self.name, time.monotonic() - started, summary)
+        except Exception:
+            # the next run is tried after the interval, like a restarted one-shot service
+            LOG.exception("Job %s failed", self.name)
+        self.next_run = time.monotonic() + self.interval
+
+
+# jobs run one by one on the main thread, fulfillments are processed by their own service,
+# so they are not delayed by long usage reporting runs
+JOBS = {
+    'usage': (runners.process_usage, True),
+    'usage-files': (runners.process_usage_files, True),
+}
+
+
+class Daemon(object):
+    """Run usage reporting jobs one by one in a single long-living process
+
+    Keystone session, OpenStack clients and caches are kept between runs.
+    SIGTERM and SIGINT stop the daemon after the running job is finished.
+    """
+
+    def __init__(self, names=None):
+        self.jobs = [Job(name, *JOBS[name]) for name in names or sorted(JOBS)]
+        self.stopped = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        LOG.info("Stopping daemon")
+        self.stopped.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        LOG.info("Daemon started: %s", ", ".join(
+            "{} every {:g} seconds".format(job.name, job.interval) for job in self.jobs))
+
+        while not self.stopped.is_set():
+            job = min(self.jobs, key=lambda j: j.next_run)
+            if self.stopped.wait(max(job.next_run - time.monotonic(), 0)):
+                break
+            job.run()
+        LOG.info("Daemon stopped")
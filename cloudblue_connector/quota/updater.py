@@ -3,11 +3,9 @@
 # This source code is distributed under MIT software license.
 # ******************************************************************************
 
-from cinderclient.exceptions import BadRequest as CinderBadRequest
-from magnumclient.exceptions import HTTPBadRequest as MagnumBadRequest
-from neutronclient.common.exceptions import BadRequest as NeutronBadRequest
-from novaclient.exceptions import BadRequest as NovaBadRequest
-from octaviaclient.api.v2.octavia import OctaviaClientException
+
+# exceptions of client libraries are imported where they are caught,
+# so the libraries are imported only when quotas are updated
 
 
 class BadQuota(Exception):
@@ -40,6 +38,7 @@ class QuotaUpdater(object):
 class CinderQuotaUpdater(QuotaUpdater):
     def _update(self, quotas):
         """Update volumes quotas"""
+        from cinderclient.exceptions import BadRequest as CinderBadRequest
 
         current_quotas = {
             key: value for key, value in
@@ -67,6 +66,7 @@ class CinderQuotaUpdater(QuotaUpdater):
 class NovaQuotaUpdater(QuotaUpdater):
     def _update(self, quotas):
         """Update cores and ram quotas"""
+        from novaclient.exceptions import BadRequest as NovaBadRequest
 
         current_quotas = {
             key: value for key, value in
@@ -84,6 +84,7 @@ class NovaQuotaUpdater(QuotaUpdater):
 class NeutronQuotaUpdater(QuotaUpdater):
     def _update(self, quotas):
         """Update floating ip quotas"""
+        from neutronclient.common.exceptions import BadRequest as NeutronBadRequest
 
         quota_and_usage = self._client.show_quota_details(self._project_id)['quota']
         current_quotas = {
@@ -104,6 +105,7 @@ class NeutronQuotaUpdater(QuotaUpdater):
 class MagnumQuotaUpdater(QuotaUpdater):
     def _update(self, quotas):
         """Update k8saas clusters quota"""
+        from magnumclient.exceptions import HTTPBadRequest as MagnumBadRequest
 
         if not self._client:
             return
@@ -126,6 +128,7 @@ class MagnumQuotaUpdater(QuotaUpdater):
 class OctaviaQuotaUpdater(QuotaUpdater):
     def _update(self, quotas):
         """Update loadbalancers quota"""
+        from octaviaclient.api.v2.octavia import OctaviaClientException
 
         if not self._client:
             return
@@ -5,50 +5,67 @@
 import warnings
 from datetime import datetime, timedelta
 
+from connect.config import Config
 from connect.rql import Query
 
 from .automation import FulfillmentAutomation, UsageAutomation, UsageFileAutomation
 from .connector import ConnectorConfig
+from .core.decorators import log_cache_stats
 
 # Enable processing of deprecation warnings
 warnings.simplefilter('default')
 
+CONFIG_FILE = '/etc/cloudblue-connector/config.json'
 
-def process_usage(project_id=None):
+
+def use_config(config=None, report_usage=False):
+    """Make the config current, load it from the config file if it is not given"""
+
+    if config is None:
+        # the first created config becomes current
+        return ConnectorConfig(file=CONFIG_FILE, report_usage=report_usage)
+    # configs of several jobs are kept by the daemon
+    Config._instance = config
+    return config
+
+
+def process_usage(project_id=None, config=None):
     """Create UsageFiles for active Assets"""
 
-    ConnectorConfig(file='/etc/cloudblue-connector/config.json', report_usage=True)
+    use_config(config, report_usage=True)
     mngr = UsageAutomation(project_id=project_id)
     # check that keystone works
     mngr.find_role('admin')
     # last day usage reporting for suspended/terminated assets
     five_days_ago = datetime.utcnow() - timedelta(days=5)
-    filters = Query().greater('updated', five_days_ago.isoformat()).in_('status', ['suspended', 'terminated'])
-    mngr.process(filters)
-
+    stopped = Query().greater('updated', five_days_ago.isoformat()).in_('status', ['suspended', 'terminated'])
     # every day usage reporting
-    filters = Query().in_('status', ['active'])
-    mngr.process(filters)
-    return mngr.usages
+    active = Query().in_('status', ['active'])
+    # both sets are processed in one run sharing prefetched projects, measures and usage files
+    mngr.process_all(stopped, active)
+    log_cache_stats()
+    return mngr.history.summary()
 
 
-def process_usage_files():
+def process_usage_files(config=None):
     """Confirm all created UsageFiles"""
 
-    ConnectorConfig(file='/etc/cloudblue-connector/config.json', report_usage=True)
+    use_config(config, report_usage=True)
     mngr = UsageFileAutomation()
     # check that keystone works
     mngr.find_role('admin')
     mngr.process()
-    return mngr.files
+    log_cache_stats()
+    return mngr.history.summary()
 
 
-def process_fulfillment():
+def process_fulfillment(config=None):
     """Process all new Fulfillments"""
 
-    ConnectorConfig(file='/etc/cloudblue-connector/config.json', report_usage=False)
+    use_config(config, report_usage=False)
     mngr = FulfillmentAutomation()
     # check that keystone works
     mngr.find_role('admin')
     mngr.process()
-    return mngr.fulfillments
+    log_cache_stats()
+    return mngr.history.summary()
@@ -30,6 +30,6 @@ setup(
     #        'cloudblue-usage=cloudblue_connector:process_usage',
     #    ],
     #},
-    scripts=['cloudblue-fulfillments', 'cloudblue-usage', 'cloudblue-usage-files'],
+    scripts=['cloudblue-fulfillments', 'cloudblue-usage', 'cloudblue-usage-files', 'cloudblue-daemon'],
     long_description=open('README.txt').read(),
 )
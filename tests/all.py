@@ -4,10 +4,23 @@
 # ******************************************************************************
 from mock import patch
 patcher_once = patch('cloudblue_connector.core.decorators.once', lambda x: x).start()
-patcher_memoize = patch('cloudblue_connector.core.decorators.memoize', lambda x: x).start()
+patcher_cached = patch('cloudblue_connector.core.decorators.cached', lambda **kwargs: lambda x: x).start()
 
 from .connector_components import test_logger_filtering,\
-    test_config_incorrect_initialization
+    test_config_incorrect_initialization,\
+    test_measures_cache,\
+    test_measures_reducers,\
+    test_aggregate_measures,\
+    test_history,\
+    test_cache,\
+    test_cached_decorator,\
+    test_daemon,\
+    test_lazy_client_imports,\
+    test_logging_queue,\
+    test_password_filter_benchmark,\
+    test_log_summary,\
+    test_json_log_format,\
+    test_log_context
 from .fulfillments import test_process_fulfillment,\
     test_process_fulfillment_payg,\
     test_process_fulfillment_test_mode
@@ -15,6 +28,24 @@ from .usage_files import test_process_usage_files
 from .usages import test_process_usage, \
     test_process_usage_test_mode, \
     test_process_usage_payg, \
+    test_process_usage_concurrent, \
+    test_process_usage_concurrent_failure, \
+    test_process_usage_traffic_rate, \
+    test_process_usage_traffic_rate_granularity, \
+    test_process_usage_concurrent_collectors, \
+    test_process_usage_collectors_pool, \
+    test_process_usage_shared_measures, \
+    test_process_usage_storage_without_snapshots, \
+    test_process_usage_storage_partial_snapshots, \
+    test_process_usage_gnocchi_granularity, \
+    test_process_usage_gnocchi_cache, \
+    test_process_usage_catch_up, \
+    test_process_usage_catch_up_one_day, \
+    test_process_usage_catch_up_checks_reports, \
+    test_process_usage_keystone_prefetch, \
+    test_process_usage_usage_files_prefetch, \
+    test_process_usage_assets_page_size, \
+    test_process_usage_gnocchi_prefetch, \
     test_process_usage_project_have_false_confirmed, \
     test_process_usage_project_id_is_none, \
     test_process_usage_found_3_usage_files, \
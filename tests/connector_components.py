@@ -2,13 +2,35 @@
 # Copyright (c) 2020-2021, Virtuozzo International GmbH.
 # This source code is distributed under MIT software license.
 # ******************************************************************************
+import asyncio
+import importlib.util
+import json
 import logging
+import os
+import random
+import re
+import string
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import pytest
+from mock import patch
 
 from cloudblue_connector.connector import ConnectorConfig
-from cloudblue_connector.core.logger import PasswordFilter
-from .data import LOGS_DATA
+from cloudblue_connector.consumption.base import aggregate_measures
+from cloudblue_connector.consumption.cache import MeasuresCache
+from cloudblue_connector.consumption.measures import hourly_sum, hourly_average, positive_delta_sum
+from cloudblue_connector.core.decorators import Cache, MISSING
+from cloudblue_connector.daemon import Daemon, JOBS
+from cloudblue_connector.core.history import History, tracked
+from cloudblue_connector.core.logger import JsonFormatter, PasswordFilter, Sampler, Summary, context_bound, \
+    context_log, enqueue_handlers, getLogger, mask_values, phase, set_context
+from .data import LOGS_DATA, GNOCCHI_TESTS_DATA
+from .data.fake_gnocchi import responses
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.INFO)
@@ -40,3 +62,474 @@ def test_logger_filtering(caplog):
     for record in caplog.records:
         if any(record.message.find(p) != -1 for p in LOGS_DATA['log_passwords']):
             pytest.fail("Passwords found in captured log records")
+
+
+def test_measures_cache(tmp_path):
+    path = os.path.join(str(tmp_path), 'cache', 'gnocchi-cache.sqlite')
+    cache = MeasuresCache(path, max_size=1024, max_age=60)
+    assert os.path.exists(path)
+
+    # only windows closed some time ago are cached
+    assert not cache.is_closed(None)
+    assert not cache.is_closed(datetime.utcnow() + timedelta(days=1))
+    assert not cache.is_closed(datetime.utcnow())
+    assert cache.is_closed(datetime.utcnow() - timedelta(days=1))
+
+    key = cache.key(operations='(metric vcpus mean)', start=datetime(2020, 6, 28), stop=datetime(2020, 6, 29))
+    assert cache.get(key) is None
+    cache.put(key, {'measures': {'aggregated': [[datetime(2020, 6, 28), 300.0, 1.0]]}})
+    assert cache.get(key) == {'measures': {'aggregated': [[datetime(2020, 6, 28), 300.0, 1.0]]}}
+
+    # the oldest responses are removed when the size limit is exceeded
+    cache.put('large', 'x' * 1000)
+    assert cache.get(key) is None
+    assert cache.get('large') == 'x' * 1000
+    # replaced responses are counted once, the total size is restored when the cache is opened again
+    cache.put('large', 'x' * 1000)
+    size = cache._size
+    assert 1000 < size <= 1024
+    assert MeasuresCache(path, max_size=1024, max_age=60)._size == size
+
+    # expired responses are not returned
+    with patch('cloudblue_connector.consumption.cache.time.time', return_value=time.time() + 61):
+        assert cache.get('large') is None
+        # and are removed with their size
+        cache.put(key, 'x')
+    assert cache.get('large') is None
+    assert cache._size == MeasuresCache(path, max_size=1024, max_age=60)._size < 100
+
+
+# reducers of consumption collectors before measures.py, the new ones give the same results
+def legacy_hourly_sum(measures):
+    return sum([m[-1] for m in measures if m[0].minute == 0] or [0])
+
+
+def legacy_hourly_average(measures):
+    hours = max(len([m for m in measures if m[0].minute == 0]), 1)
+    values = [m[-1] for m in measures] or [0]
+    return (float(sum(values)) / len(values)) * hours
+
+
+def legacy_positive_delta_sum(measures):
+    result = 0.0
+    if len(measures):
+        previous_value = measures[0][2]
+        for m in measures:
+            if previous_value < m[2]:
+                result += m[2] - previous_value
+            previous_value = m[2]
+    return result
+
+
+def test_measures_reducers():
+    series = [
+        [],
+        [[datetime(2020, 6, 28, hour, minute), 300.0, 0.1] for hour in range(24) for minute in (0, 30)],
+        [[datetime(2020, 6, 28, 10, 5), 300.0, 1.0]],
+    ] + [responses[name]['measures']['aggregated'] for name in (
+        'response_memory', 'response_volume_size', 'response_ip_floating', 'response_loadbalancer')]
+    for measures in series:
+        assert hourly_sum(measures) == legacy_hourly_sum(measures)
+        assert hourly_average(measures) == legacy_hourly_average(measures)
+
+    for response in (GNOCCHI_TESTS_DATA['traffic'], GNOCCHI_TESTS_DATA['traffic_counter_reset']):
+        measures = list(response['measures'].values())[0]['network.outgoing.bytes']['mean']
+        assert positive_delta_sum(measures) == legacy_positive_delta_sum(measures)
+
+
+def test_aggregate_measures():
+    # Instances measured in different parts of the window
+    hours = [datetime(2020, 6, 28, hour) for hour in range(4)]
+    first = [(timestamp, 3600.0, 2.0) for timestamp in hours]
+    second = [(timestamp, 3600.0, 1.0) for timestamp in hours[2:]] + [(datetime(2020, 6, 28, 4), 3600.0, 1.0)]
+    # instance without measures in the window
+    third = []
+
+    # every measured timestamp is summed over instances measured at it
+    assert aggregate_measures([first, second, third], 'sum') == [
+        (datetime(2020, 6, 28, 0), 3600.0, 2.0),
+        (datetime(2020, 6, 28, 1), 3600.0, 2.0),
+        (datetime(2020, 6, 28, 2), 3600.0, 3.0),
+        (datetime(2020, 6, 28, 3), 3600.0, 3.0),
+        (datetime(2020, 6, 28, 4), 3600.0, 1.0),
+    ]
+    assert aggregate_measures(iter([first, second]), 'count') == [
+        (datetime(2020, 6, 28, 0), 3600.0, 1),
+        (datetime(2020, 6, 28, 1), 3600.0, 1),
+        (datetime(2020, 6, 28, 2), 3600.0, 2),
+        (datetime(2020, 6, 28, 3), 3600.0, 2),
+        (datetime(2020, 6, 28, 4), 3600.0, 1),
+    ]
+    # coarse granularity goes first
+    assert aggregate_measures([[(hours[0], 300.0, 2.0)], first[:1]], 'sum') == [
+        (hours[0], 3600.0, 2.0),
+        (hours[0], 300.0, 2.0),
+    ]
+    # measures of a single resource are their sum
+    assert aggregate_measures([first, third], 'sum') == first
+    assert aggregate_measures([third], 'sum') == []
+
+
+def test_history():
+    class Automation(object):
+        def __init__(self):
+            self.history = History(size=2)
+
+        @tracked
+        def process_request(self, request):
+            if request.id == 'skip':
+                raise ValueError()
+
+    automation = Automation()
+    for request_id in ('first', 'skip', 'last'):
+        try:
+            automation.process_request(type('Request', (object,), {'id': request_id}))
+        except ValueError:
+            pass
+
+    # only the last requests are kept, totals count all of them
+    assert [(e.request_id, e.outcome) for e in automation.history] == [('skip', 'ValueError'), ('last', 'done')]
+    summary = automation.history.summary()
+    assert summary['processed'] == 3
+    assert summary['outcomes'] == {'done': 2, 'ValueError': 1}
+
+
+def test_cache():
+    cache = Cache('test', ttl=60, maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # the least recently used result is evicted
+    cache.put('c', 3)
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+
+    cache.invalidate('a')
+    assert cache.get('a') is MISSING
+    # expired results are evicted
+    with patch('cloudblue_connector.core.decorators.time.monotonic', return_value=time.monotonic() + 60):
+        assert cache.get('c') is MISSING
+
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'evictions': 2, 'size': 0}
+
+
+def test_cached_decorator():
+    # tests/all.py replaces cached with an identity function, the decorator is tested on a separate module copy
+    spec = importlib.util.find_spec('cloudblue_connector.core.decorators')
+    decorators = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(decorators)
+
+    class Manager(object):
+        def __init__(self):
+            self.calls = []
+
+        @decorators.cached(ttl=60, maxsize=2)
+        def find(self, name, domain=None):
+            self.calls.append((name, domain))
+            return name, domain
+
+    manager = Manager()
+    assert manager.find('a', domain='d') == ('a', 'd')
+    # results are shared by instances
+    assert Manager().find('a', domain='d') == ('a', 'd')
+    # keyword arguments are a part of the key, positional and keyword arguments are different keys
+    assert manager.find('a') == ('a', None)
+    assert manager.find('a', 'd') == ('a', 'd')
+    assert manager.calls == [('a', 'd'), ('a', None), ('a', 'd')]
+
+    # the least recently used result is evicted
+    Manager.find.cache.invalidate()
+    manager.calls = []
+    manager.find('a')
+    manager.find('b')
+    manager.find('a')
+    manager.find('c')
+    manager.find('a')
+    manager.find('b')
+    assert manager.calls == [('a', None), ('b', None), ('c', None), ('b', None)]
+
+    # results are removed by invalidate with the same arguments
+    Manager.find.invalidate('b')
+    manager.find('b')
+    manager.find('b')
+    assert manager.calls[4:] == [('b', None)]
+
+    # expired results are evicted
+    with patch.object(decorators.time, 'monotonic', return_value=time.monotonic() + 60):
+        manager.find('b')
+    assert manager.calls[5:] == [('b', None)]
+
+    # calls with unhashable arguments are not cached
+    with patch.object(decorators.LOG, 'warning') as warning:
+        assert manager.find(['c']) == (['c'], None)
+        assert manager.find(['c']) == (['c'], None)
+    assert manager.calls[6:] == [(['c'], None), (['c'], None)]
+    assert warning.call_count == 2
+
+
+def test_daemon():
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['daemonIntervals'] = {'usage': 0}
+    runs = []
+
+    def runner(config=None):
+        runs.append(config)
+        if len(runs) == 3:
+            daemon.stop()
+        elif len(runs) == 2:
+            raise Exception('failed run is repeated')
+        return {}
+
+    with patch('cloudblue_connector.daemon.ConnectorConfig', return_value=config), \
+            patch.dict(JOBS, {'usage': (runner, True)}):
+        daemon = Daemon(['usage'])
+        daemon.run()
+
+    # the same config is reused by all runs
+    assert runs == [config, config, config]
+    # fulfillments are processed by their own service, not delayed by usage reporting jobs
+    assert sorted(JOBS) == ['usage', 'usage-files']
+
+
+def test_lazy_client_imports():
+    # only Keystone client is imported with the connector, others are imported on first use
+    code = "import sys, cloudblue_connector.runners; print(' '.join(sorted(sys.modules)))"
+    modules = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+    for module in ('cinderclient', 'glanceclient', 'gnocchiclient', 'magnumclient', 'neutronclient',
+                   'novaclient', 'octaviaclient'):
+        assert module not in modules
+    assert 'keystoneclient' in modules
+
+
+@pytest.mark.parametrize("policy", ('block', 'drop'))
+def test_logging_queue(policy):
+    class Handler(logging.Handler):
+        def __init__(self):
+            super(Handler, self).__init__()
+            self.released = threading.Event()
+            self.messages = []
+            self.threads = []
+
+        def emit(self, record):
+            self.released.wait(10)
+            self.messages.append(record.getMessage())
+            self.threads.append(threading.current_thread())
+
+    log = logging.getLogger('test_logging_queue_' + policy)
+    log.propagate = False
+    handler = Handler()
+    log.addHandler(handler)
+    queue_handler, listener, flush = enqueue_handlers(log, size=2, policy=policy)
+    try:
+        if policy == 'block':
+            handler.released.set()
+        for i in range(10):
+            log.info("message %s", i)
+        handler.released.set()
+    finally:
+        flush()
+
+    # queued records are handled on a background thread, handlers are restored on exit
+    assert log.handlers == [handler]
+    if policy == 'block':
+        assert handler.messages == ["message {}".format(i) for i in range(10)]
+        assert threading.current_thread() not in handler.threads
+    else:
+        assert queue_handler.dropped > 0
+        assert len(handler.messages) + queue_handler.dropped == 11
+        assert threading.current_thread() not in handler.threads[:-1]
+        assert handler.messages[-1] == "{} log records were dropped, logging queue was full".format(
+            queue_handler.dropped)
+
+
+def test_password_filter_benchmark():
+    ConnectorConfig(file='config.json.example')
+
+    # masking is the same as of the previous implementation
+    def legacy_mask(msg):
+        match = None
+        if re.search(r'"type":\s?"password"', msg):
+            for pattern in PasswordFilter.password_patterns:
+                match = re.search(pattern, msg.replace("\n", "\\n").replace("\\'", "'"))
+                if match:
+                    break
+        if not match:
+            return msg
+        try:
+            payload = json.loads(match.group(1).replace("\\x", "\\u00"))
+        except ValueError:
+            return msg
+        payload = payload if isinstance(payload, list) else [payload]
+        found_passwords = {}
+        for node in payload:
+            for params in node.get('params', []), node.get('asset', {}).get('params', []):
+                for p in params:
+                    if p.get('type', None) == 'password' and p.get('value', None):
+                        found_passwords[re.escape(p['value'])] = ''
+        return re.sub("|".join(found_passwords.keys()), "***hidden***", msg, flags=re.M)
+
+    # asset list as returned by Connect, with random passwords
+    rnd = random.Random(0)
+    assets = [{"id": "AS-{:04d}-{:04d}".format(i, i * 7 % 10000), "status": "active",
+               "tiers": {"customer": {"name": "Customer {} LLC".format(i), "contact_info": {"city": "Springfield"}}},
+               "params": [
+                   {"id": "password", "type": "password",
+                    "value": ''.join(rnd.choice(string.ascii_letters + string.digits) for _ in range(16))},
+                   {"id": "project_id", "type": "text", "value": '{:032x}'.format(rnd.getrandbits(128))},
+               ]} for i in range(500)]
+    large = 'Function `ApiClient.get` return: (\'{}\', 200)'.format(json.dumps(assets))
+    messages = LOGS_DATA['log_messages'] + [large, 'Function `ApiClient.get` return: (\'[]\', 200)']
+
+    password_filter = PasswordFilter()
+    masked = {}
+    durations = {}
+    for name, mask in (('legacy', legacy_mask), ('filter', None)):
+        started = time.perf_counter()
+        for _ in range(3):
+            for message in messages:
+                record = logging.LogRecord('connect', logging.DEBUG, __file__, 0, message, None, None)
+                if mask is None:
+                    password_filter.filter(record)
+                    masked.setdefault(message, set()).add(record.msg)
+                else:
+                    masked.setdefault(message, set()).add(mask(message))
+        durations[name] = time.perf_counter() - started
+    LOG.info("Password filter: %.3f seconds, legacy: %.3f seconds", durations['filter'], durations['legacy'])
+
+    for message in messages:
+        assert len(masked[message]) == 1
+    # the first listed value wins, like in alternation of regular expression
+    assert mask_values('abcd bc', ['bc', 'abc', 'd']) == re.sub('bc|abc|d', '***hidden***', 'abcd bc')
+
+
+def test_log_summary():
+    assert str(Summary([])) == '0 items []'
+    assert str(Summary([{'id': 'a'}, {'id': 'b'}])) == '2 items [a, b]'
+    assert str(Summary(range(100), max_ids=3)) == '100 items [0, 1, 2, ...]'
+    assert str(Summary(iter(['x' * 2000]), key=len)) == '1 items [2000]'
+    assert len(str(Summary(['x' * 2000]))) == Summary.max_length
+
+    sampled = Sampler(0.25)
+    assert [sampled() for _ in range(8)] == [True, False, False, False, True, False, False, False]
+    assert not any(Sampler(0)() for _ in range(4))
+    assert all(Sampler()() for _ in range(4))
+    assert all(Sampler(None)() for _ in range(4))
+    # rate of a string config value
+    sampled = Sampler('0.5')
+    assert [sampled() for _ in range(4)] == [True, False, True, False]
+
+
+def test_json_log_format():
+    class Records(logging.Handler):
+        def __init__(self):
+            super(Records, self).__init__()
+            self.lines = []
+
+        def emit(self, record):
+            self.lines.append(json.loads(self.format(record)))
+
+    class Request(object):
+        def __init__(self, id, asset=None):
+            self.id = id
+            self.asset = asset
+
+    class Processor(object):
+        @context_log
+        def process_request(self, request):
+            log.info("started")
+            set_context(project_id='project')
+            with phase('keystone'):
+                time.sleep(0.01)
+                log.info("waiting")
+            context_bound(log.info)("in worker")
+            raise ValueError('failed')
+
+    log = getLogger('JsonTest')
+    handler = Records()
+    handler.setFormatter(JsonFormatter())
+    log.addHandler(handler)
+    logging.getLogger('Phase').addHandler(handler)
+    try:
+        with pytest.raises(ValueError):
+            Processor().process_request(Request('PR-1', Request('AS-1')))
+        log.info("outside")
+    finally:
+        log.removeHandler(handler)
+        logging.getLogger('Phase').removeHandler(handler)
+
+    started, waiting, finished, worker, outside = handler.lines
+    assert started['message'] == 'started' and started['level'] == 'INFO'
+    assert (started['request_id'], started['asset_id'], started['project_id'], started['phase']) == \
+        ('PR-1', 'AS-1', None, None)
+    assert started['elapsed_ms'] >= 0
+    assert (waiting['project_id'], waiting['phase']) == ('project', 'keystone')
+    assert finished['message'].startswith('Phase keystone finished') and finished['elapsed_ms'] >= 10
+    assert (worker['request_id'], worker['project_id'], worker['phase']) == ('PR-1', 'project', None)
+    assert [outside[field] for field in JsonFormatter.fields] == [None] * len(JsonFormatter.fields)
+
+
+def test_log_context():
+    class Records(logging.Handler):
+        def __init__(self):
+            super(Records, self).__init__()
+            self.records = []
+
+        def emit(self, record):
+            self.records.append((record.getMessage(), record.request_id, record.name))
+
+    class Request(object):
+        def __init__(self, id):
+            self.id = id
+
+    class Processor(object):
+        def __init__(self):
+            self.barrier = threading.Barrier(2)
+
+        @context_log
+        def process_request(self, request):
+            # both requests are in progress at the same time
+            self.barrier.wait(timeout=5)
+            log.info(request.id)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(context_bound(log.info), request.id + ' worker').result()
+                executor.submit(log.info, request.id + ' unbound').result()
+            if request.id == 'PR-2':
+                raise ValueError('failed')
+
+        @context_log
+        async def process_async(self, request):
+            await asyncio.sleep(0.01)
+            await asyncio.create_task(self.log_async(request.id))
+
+        async def log_async(self, message):
+            log.info(message)
+
+    log = getLogger('ContextTest')
+    handler = Records()
+    log.addHandler(handler)
+    try:
+        processor = Processor()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(processor.process_request, Request(id)) for id in ('PR-1', 'PR-2')]
+        assert futures[0].result() is None
+        with pytest.raises(ValueError):
+            futures[1].result()
+
+        async def process_all():
+            await asyncio.gather(*(processor.process_async(Request(id)) for id in ('PR-3', 'PR-4')))
+        asyncio.run(process_all())
+        log.info('outside')
+    finally:
+        log.removeHandler(handler)
+
+    assert sorted(handler.records) == [
+        ('PR-1', 'PR-1', 'ContextTest'),
+        ('PR-1 unbound', None, 'ContextTest'),
+        ('PR-1 worker', 'PR-1', 'ContextTest'),
+        ('PR-2', 'PR-2', 'ContextTest'),
+        ('PR-2 unbound', None, 'ContextTest'),
+        ('PR-2 worker', 'PR-2', 'ContextTest'),
+        ('PR-3', 'PR-3', 'ContextTest'),
+        ('PR-4', 'PR-4', 'ContextTest'),
+        ('outside', None, 'ContextTest'),
+    ]
@@ -14,7 +14,7 @@ with open('tests/data/json/response_traffic.json') as json_file:
 
 aggregated_responses = ['response_memory', 'response_volume_size', 'response_volume_snapshot_size',
                         'response_ip_floating', 'response_coe_cluster', 'response_instance_vcpus',
-                        'response_loadbalancer']
+                        'response_loadbalancer', 'response_traffic_rate']
 for response in aggregated_responses:
     with open('tests/data/json/' + response + '.json') as json_file:
         data = json.load(json_file)
@@ -24,18 +24,109 @@ for response in aggregated_responses:
         data['measures']['aggregated'] = measures
         responses[response] = data
 
+
+def per_volume_response(size_response, snapshot_size_response):
+    """Volume size and snapshot size of a single volume"""
+
+    return {'measures': {
+        '11111111-1111-1111-1111-111111111121': {
+            'volume.size': {'mean': size_response['measures']['aggregated']},
+            'volume.snapshot.size': {'mean': snapshot_size_response['measures']['aggregated']},
+        },
+    }}
+
+
+STORAGE_OPERATION = '(metric (volume.size mean) (volume.snapshot.size mean))'
+responses['response_volume'] = per_volume_response(
+    responses['response_volume_size'], responses['response_volume_snapshot_size'])
+
+
+def per_instance_response(vcpus_response, memory_response):
+    """Vcpus and memory split between two instances"""
+
+    def half(response):
+        return {'mean': [[m[0], m[1], m[2] / 2] for m in response['measures']['aggregated']]}
+
+    return {'measures': {
+        '11111111-1111-1111-1111-111111111111': {
+            'vcpus': half(vcpus_response),
+            'memory': half(memory_response),
+        },
+        '11111111-1111-1111-1111-111111111112': {
+            'vcpus': half(vcpus_response),
+            'memory': half(memory_response),
+        },
+    }}
+
+
+responses['response_instance'] = per_instance_response(
+    responses['response_instance_vcpus'], responses['response_memory'])
+
+
+def on_date(timestamp, date):
+    if isinstance(timestamp, str):
+        timestamp = dateutil.parser.parse(timestamp)
+    return timestamp.replace(year=date.year, month=date.month, day=date.day)
+
+
+def daily_response(response, dates):
+    """Measures of a single day repeated for each of the dates"""
+
+    if isinstance(response, dict):
+        return {key: daily_response(value, dates) for key, value in response.items()}
+    if isinstance(response, list):
+        if response and isinstance(response[0], list) and len(response[0]) == 3:
+            return [[on_date(m[0], d), m[1], m[2]] for d in dates for m in response]
+        return [daily_response(item, dates) for item in response]
+    return response
+
+
+def counter_reset_response(response, index, metric='network.outgoing.bytes'):
+    """Cumulative counters restarted from zero at the index"""
+
+    measures = {}
+    for resource_id, resource in response['measures'].items():
+        values = resource[metric]['mean']
+        measures[resource_id] = {metric: {'mean': values[:index] + [
+            [m[0], m[1], m[2] - values[index][2]] for m in values[index:]]}}
+    return {'measures': measures}
+
+
+def counter_reset_rate_response(response, timestamp):
+    """Rates of counters restarted from zero at the timestamp, the negative rate is clipped to zero"""
+
+    return {'measures': {'aggregated': [
+        [m[0], m[1], 0.0 if m[0] == timestamp else m[2]] for m in response['measures']['aggregated']]}}
+
+
+def grouped_response(response, group_key='project_id', group_value='TestProjectId'):
+    """Aggregates response with groupby for a single group and one more empty group"""
+
+    return [
+        {'group': {group_key: 'OtherGroupValue'}, 'measures': {'measures': {'aggregated': []}}},
+        {'group': {group_key: group_value}, 'measures': response},
+    ]
+
+
+# ids of Windows VMs of GNOCCHI_TESTS_DATA running in the report window, vm7 is created after it
+WINDOWS_VMS_IDS = ['22222222-2222-2222-2222-2222222222{:02d}'.format(i) for i in range(1, 13) if i != 7]
+
 GNOCCHI_MOCK_DATA = {
     'aggregates.fetch': {
         (): {
+            (('resource_type', 'instance'),
+             ('operations', '(aggregate sum (metric vcpus mean))'),
+             ('search', 'id in {}'.format(json.dumps(WINDOWS_VMS_IDS))),):
+                [{'group': {'id': vm_id}, 'measures': responses['response_instance_vcpus']} for vm_id in WINDOWS_VMS_IDS],
+            (('resource_type', 'instance'),
+             ('operations', '(metric (vcpus mean) (memory mean))'),):
+                 responses['response_instance'],
             (('resource_type', 'instance'),
              ('operations', '(aggregate sum (metric memory mean))'),):
                  responses['response_memory'],
             (('resource_type', 'volume'),
-             ('operations', '(aggregate sum (metric volume.size mean))'),):
-                 responses['response_volume_size'],
-            (('resource_type', 'volume'),
-             ('operations', '(aggregate sum (metric volume.snapshot.size mean))'),):
-                 responses['response_volume_snapshot_size'],
+             ('operations', STORAGE_OPERATION),):
+                 responses['response_volume'],
             (('resource_type', 'network'),
              ('operations', '(aggregate count (metric ip.floating mean))'),):
                  responses['response_ip_floating'],
@@ -50,12 +141,44 @@ GNOCCHI_MOCK_DATA = {
                  responses['response_instance_vcpus'],
             (('resource_type', 'generic'),
              ('operations', '(metric network.outgoing.bytes mean)'),
-             ('search', 'id=11111111-1111-1111-1111-111111111113'),):
+             ('search', 'id in ["11111111-1111-1111-1111-111111111113"]'),):
                  responses['response_traffic'],
         },
     },
 }
 
+
+# Per project requests for CPU, RAM, FloatingIP, LoadBalancer and K8saas are not mocked
+GNOCCHI_PREFETCH_MOCK_DATA = {
+    'aggregates.fetch': {
+        (): {
+            (('resource_type', 'instance'),
+             ('operations', '(aggregate sum (metric memory mean))'),
+             ('search', 'project_id!=null'),):
+                grouped_response(responses['response_memory']),
+            (('resource_type', 'instance'),
+             ('operations', '(aggregate sum (metric vcpus mean))'),
+             ('search', 'project_id!=null'),):
+                grouped_response(responses['response_instance_vcpus']),
+            (('resource_type', 'network'),
+             ('operations', '(aggregate count (metric ip.floating mean))'),
+             ('search', 'project_id!=null'),):
+                grouped_response(responses['response_ip_floating']),
+            (('resource_type', 'loadbalancer'),
+             ('operations', '(aggregate count (metric network.services.lb.loadbalancer mean))'),
+             ('search', 'project_id!=null'),):
+                grouped_response(responses['response_loadbalancer']),
+            (('resource_type', 'coe_cluster'),
+             ('operations', '(aggregate count (metric magnum.cluster mean))'),
+             ('search', 'project_id!=null'),):
+                grouped_response(responses['response_coe_cluster']),
+            (('resource_type', 'volume'),
+             ('operations', STORAGE_OPERATION),):
+                responses['response_volume'],
+        },
+    },
+}
+
 GNOCCHI_TESTS_DATA = {
     'images_list': [
         {'os_type': 'other', 'id': '11111111-1111-1111-1111-111111111111'},
@@ -67,42 +190,49 @@ GNOCCHI_TESTS_DATA = {
          "created_at": (datetime.utcnow() - timedelta(days=5)).strftime('%Y-%m-%d') + "T17:06:26+00:00",
          "deleted_at": None}
     ],
-    'instance_network_interface': [{'id': '11111111-1111-1111-1111-111111111113'}],
+    'traffic': responses['response_traffic'],
+    'traffic_counter_reset': counter_reset_response(responses['response_traffic'], 150),
+    # response of Gnocchi to OutgoingTraffic.rate_operation for the traffic
+    'traffic_rate': responses['response_traffic_rate'],
+    'traffic_rate_counter_reset': counter_reset_rate_response(
+        responses['response_traffic_rate'], dateutil.parser.parse('2021-03-24T12:30:00+00:00')),
+    'instance_network_interface': [{'id': '11111111-1111-1111-1111-111111111113',
+                                    'instance_id': '11111111-1111-1111-1111-111111111111'}],
     'windows_vms': [
-        {"display_name": "vm1",
+        {"display_name": "vm1", "id": "22222222-2222-2222-2222-222222222201",
          "created_at": (datetime.utcnow() - timedelta(days=5)).strftime('%Y-%m-%d') + "T17:06:26+00:00",
          "deleted_at": None},
-        {"display_name": "vm2",
+        {"display_name": "vm2", "id": "22222222-2222-2222-2222-222222222202",
          "created_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T01:26:26+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=3)).strftime('%Y-%m-%d') + "T03:36:26+00:00"},
-        {"display_name": "vm3",
+        {"display_name": "vm3", "id": "22222222-2222-2222-2222-222222222203",
          "created_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T02:57:26+00:00",
          "deleted_at": None},
-        {"display_name": "vm4",
+        {"display_name": "vm4", "id": "22222222-2222-2222-2222-222222222204",
          "created_at": (datetime.utcnow() - timedelta(days=5)).strftime('%Y-%m-%d') + "T22:57:26+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T19:01:26+00:00"},
-        {"display_name": "vm5",
+        {"display_name": "vm5", "id": "22222222-2222-2222-2222-222222222205",
          "created_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T09:32:26+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T14:59:26+00:00"},
-        {"display_name": "vm6",
+        {"display_name": "vm6", "id": "22222222-2222-2222-2222-222222222206",
          "created_at": (datetime.utcnow() - timedelta(days=5)).strftime('%Y-%m-%d') + "T11:12:26+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=3)).strftime('%Y-%m-%d') + "T04:01:26+00:00"},
-        {"display_name": "vm7",
+        {"display_name": "vm7", "id": "22222222-2222-2222-2222-222222222207",
          "created_at": (datetime.utcnow() - timedelta(days=3)).strftime('%Y-%m-%d') + "T05:12:26+00:00",
          "deleted_at": None},
-        {"display_name": "vm8",
+        {"display_name": "vm8", "id": "22222222-2222-2222-2222-222222222208",
          "created_at": (datetime.utcnow() - timedelta(days=5)).strftime('%Y-%m-%d') + "T23:50:26+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=5)).strftime('%Y-%m-%d') + "T23:59:26+00:00"},
-        {"display_name": "vm9",
+        {"display_name": "vm9", "id": "22222222-2222-2222-2222-222222222209",
          "created_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T23:50:26+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T23:59:00+00:00"},
-        {"display_name": "vm10",
+        {"display_name": "vm10", "id": "22222222-2222-2222-2222-222222222210",
          "created_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T21:59:58+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T23:59:59+00:00"},
-        {"display_name": "vm11",
+        {"display_name": "vm11", "id": "22222222-2222-2222-2222-222222222211",
          "created_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T00:00:00+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=3)).strftime('%Y-%m-%d') + "T00:00:00+00:00"},
-        {"display_name": "vm12",
+        {"display_name": "vm12", "id": "22222222-2222-2222-2222-222222222212",
          "created_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T20:50:00+00:00",
          "deleted_at": (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d') + "T22:51:00+00:00"}
     ]
@@ -110,5 +240,8 @@ GNOCCHI_TESTS_DATA = {
 
 __all__ = [
     'GNOCCHI_MOCK_DATA',
-    'GNOCCHI_TESTS_DATA'
+    'GNOCCHI_PREFETCH_MOCK_DATA',
+    'GNOCCHI_TESTS_DATA',
+    'STORAGE_OPERATION',
+    'daily_response'
 ]
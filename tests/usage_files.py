@@ -57,4 +57,7 @@ def test_process_usage_files(additional_defaults, expected_raise):
         'cloudblue_connector.runners.UsageFileAutomation.process_request',
         new=process_request_wrapper(UsageFileAutomation.process_request, expected_exception=expected_raise)
     ):
-        process_usage_files()
+        summary = process_usage_files()
+
+    assert summary['processed'] == 1
+    assert summary['outcomes'] == {expected_raise.__name__: 1}
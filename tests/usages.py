@@ -5,17 +5,23 @@
 import copy
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import pytest
+import pytz
 from connect.config import Config as CloudblueConfig
 from connect.models.schemas import UsageFileSchema, AssetSchema
 from mock import patch, MagicMock
 
 from cloudblue_connector.automation.usage import UsageAutomation
+from cloudblue_connector.consumption import ConsumptionError, OutgoingTraffic, cache
 from cloudblue_connector.runners import ConnectorConfig, process_usage
 from .data import MAIN_DEFAULTS, PROJECT_DEFAULTS, USAGE_DEFAULTS, PAYG_ADDITIONAL_USAGE_DEFAULTS,\
-    GNOCCHI_TESTS_DATA, GNOCCHI_MOCK_DATA
+    GNOCCHI_TESTS_DATA, GNOCCHI_MOCK_DATA, GNOCCHI_PREFETCH_MOCK_DATA, STORAGE_OPERATION, daily_response
+from .data.fake_gnocchi import responses
 from .helpers.fake_methods import make_fake_apimethod, process_request_wrapper, submit_usage_wrapper,\
     make_usage_values_checker
 from .helpers.fake_objects import FakeProject, gen_fake_by_schema
@@ -27,6 +33,7 @@ LOG.setLevel(logging.INFO)
 
 def _base_test_process_usage(
         additional_keystone_mock_tuples=None,
+        gnocchi_mock_data=None,
         additional_gnocchi_mock_data=None,
         additional_glance_mock_tuples=None,
         additional_apiget_responses=None,
@@ -93,7 +100,7 @@ def _base_test_process_usage(
     keystone_client_mock = OpenstackClientMock('KeystoneClient', keystone_mock_data_tuples)
 
     # GnocchiClient
-    gnocchi_mock_data = GNOCCHI_MOCK_DATA.copy()
+    gnocchi_mock_data = (gnocchi_mock_data or GNOCCHI_MOCK_DATA).copy()
     if additional_gnocchi_mock_data:
         for key in additional_gnocchi_mock_data.keys():
             if gnocchi_mock_data.get(key) is None:
@@ -208,6 +215,627 @@ def test_process_usage_payg(additional_glance_mock_tuples, additional_gnocchi_mo
     )
 
 
+def test_process_usage_concurrent():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Process assets with a pool of workers
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['usageWorkers'] = 4
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+        additional_defaults=PAYG_ADDITIONAL_USAGE_DEFAULTS,
+        additional_gnocchi_mock_data={'resource.search': {
+            (): {
+                (('resource_type', 'instance'),): GNOCCHI_TESTS_DATA['single_vm'],
+                (('resource_type', 'instance_network_interface'),): GNOCCHI_TESTS_DATA['instance_network_interface']
+            },
+        }},
+        expected_value_checker=make_usage_values_checker(
+            {
+                'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+                'Win_VM_consumption': 0, 'Outgoing_Traffic_consumption': 0.4761,
+            }
+        ),
+        patched_config=config
+    )
+
+
+def test_process_usage_concurrent_failure():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # No more assets are submitted after a failed one, as in sequential processing
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['usageWorkers'] = 2
+    processed = []
+
+    def dispatch_request(request):
+        processed.append(request)
+        if request == 3:
+            raise RuntimeError('Asset failed')
+
+    automation = UsageAutomation()
+    with patch.object(automation, 'list_all', return_value=iter(range(100))), \
+            patch.object(automation, 'dispatch_request', side_effect=dispatch_request):
+        with pytest.raises(RuntimeError):
+            automation.process_all()
+
+    assert 3 in processed
+    # at most twice as many assets as workers are in flight
+    assert len(processed) <= 3 + 1 + 2 * 2
+
+
+@pytest.mark.parametrize(
+    "traffic_response,rate_response,expected_traffic",
+    (
+        (GNOCCHI_TESTS_DATA['traffic'], GNOCCHI_TESTS_DATA['traffic_rate'], 0.4761),
+        (GNOCCHI_TESTS_DATA['traffic_counter_reset'], GNOCCHI_TESTS_DATA['traffic_rate_counter_reset'], 0.4755),
+    )
+)
+def test_process_usage_traffic_rate(traffic_response, rate_response, expected_traffic):
+    # Deltas computed by Gnocchi give the same traffic as deltas of counters
+    search = ('search', 'id in ["11111111-1111-1111-1111-111111111113"]')
+    for rate_aggregation in (False, True):
+        # Clean global cloudblue config instance
+        CloudblueConfig._instance = None
+        config = ConnectorConfig(file='config.json.example', report_usage=True)
+        config._misc['trafficRateAggregation'] = rate_aggregation
+        gnocchi_mock_data = copy.deepcopy(GNOCCHI_MOCK_DATA)
+        gnocchi_mock_data['aggregates.fetch'][()].update({
+            (('resource_type', 'generic'), ('operations', '(metric network.outgoing.bytes mean)'), search,):
+                traffic_response,
+            (('resource_type', 'generic'), ('operations', OutgoingTraffic.rate_operation), search, ('fill', 'ffill'),):
+                rate_response,
+        })
+
+        _base_test_process_usage(
+            additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+            additional_defaults=PAYG_ADDITIONAL_USAGE_DEFAULTS,
+            gnocchi_mock_data=gnocchi_mock_data,
+            additional_gnocchi_mock_data={'resource.search': {
+                (): {
+                    (('resource_type', 'instance'),): GNOCCHI_TESTS_DATA['single_vm'],
+                    (('resource_type', 'instance_network_interface'),): GNOCCHI_TESTS_DATA['instance_network_interface']
+                },
+            }},
+            expected_value_checker=make_usage_values_checker(
+                {
+                    'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                    'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+                    'Win_VM_consumption': 0, 'Outgoing_Traffic_consumption': expected_traffic,
+                }
+            ),
+            patched_config=config
+        )
+
+
+@pytest.mark.parametrize(
+    "granularities,expected_traffic",
+    (
+        # deltas of the finest granularity of the archive policy are summed
+        ({}, 0.4761),
+        # only deltas of the configured granularity are requested
+        ({'OutgoingTraffic': 3600}, 0.238),
+    )
+)
+def test_process_usage_traffic_rate_granularity(granularities, expected_traffic):
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['trafficRateAggregation'] = True
+    config._misc['gnocchiGranularity'] = granularities
+    # hourly deltas of a coarser archive, different from the fine ones to tell them apart
+    hourly = [[datetime(2021, 3, 24, hour, tzinfo=pytz.utc), 3600.0, 10400.0] for hour in range(1, 24)] + \
+        [[datetime(2021, 3, 25, tzinfo=pytz.utc), 3600.0, 10400.0]]
+    search = ('search', 'id in ["11111111-1111-1111-1111-111111111113"]')
+    gnocchi_mock_data = copy.deepcopy(GNOCCHI_MOCK_DATA)
+    gnocchi_mock_data['aggregates.fetch'][()].update({
+        (('resource_type', 'generic'), ('operations', OutgoingTraffic.rate_operation), search, ('fill', 'ffill'),
+         ('granularity', 3600),):
+            {'measures': {'aggregated': hourly}},
+        (('resource_type', 'generic'), ('operations', OutgoingTraffic.rate_operation), search, ('fill', 'ffill'),):
+            {'measures': {'aggregated': hourly + GNOCCHI_TESTS_DATA['traffic_rate']['measures']['aggregated']}},
+    })
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+        additional_defaults=PAYG_ADDITIONAL_USAGE_DEFAULTS,
+        gnocchi_mock_data=gnocchi_mock_data,
+        additional_gnocchi_mock_data={'resource.search': {
+            (): {
+                (('resource_type', 'instance'),): GNOCCHI_TESTS_DATA['single_vm'],
+                (('resource_type', 'instance_network_interface'),): GNOCCHI_TESTS_DATA['instance_network_interface']
+            },
+        }},
+        expected_value_checker=make_usage_values_checker(
+            {
+                'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+                'Win_VM_consumption': 0, 'Outgoing_Traffic_consumption': expected_traffic,
+            }
+        ),
+        patched_config=config
+    )
+
+
+def test_process_usage_concurrent_collectors():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Run consumption collectors in parallel
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['collectorWorkers'] = 8
+    config._misc['collectorTimeout'] = 60
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+        expected_value_checker=make_usage_values_checker(
+            {
+                'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+            }
+        ),
+        patched_config=config
+    )
+
+    # Failed collector stops reporting of the asset
+    CloudblueConfig._instance = None
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['collectorWorkers'] = 8
+    with patch(
+        'cloudblue_connector.consumption.FloatingIP.collect_consumption',
+        side_effect=RuntimeError('Gnocchi is not available')
+    ):
+        try:
+            _base_test_process_usage(
+                additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+                expected_process_exception=ConsumptionError,
+                patched_config=config
+            )
+        except ConsumptionError as ex:
+            if 'Floating_IP_consumption' not in str(ex):
+                pytest.fail('Failed item is not reported.')
+        else:
+            pytest.fail('Exception expected.')
+
+
+def test_process_usage_collectors_pool():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Collectors of all assets share one pool
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['collectorWorkers'] = 8
+    config._misc['usageWorkers'] = 2
+    defaults_ = copy.deepcopy(MAIN_DEFAULTS)
+    defaults_.update(USAGE_DEFAULTS)
+    fake_asset = gen_fake_by_schema(AssetSchema(), defaults=defaults_)
+    submitted = []
+
+    with patch('cloudblue_connector.automation.usage.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as pools:
+        _base_test_process_usage(
+            additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS).update(
+                last_usage_report_confirmed=True)),),
+            additional_apiget_responses={
+                ('assets?in(status,(active))&in(product.id,(PRD-063-065-206))', ''):
+                    (json.dumps([fake_asset, dict(fake_asset, id='AS-0000-0000-0001')]), 200),
+            },
+            expected_value_checker=submitted.append,
+            patched_config=config
+        )
+    assert len(submitted) == 2
+    # one pool of assets and one of collectors
+    assert pools.call_count == 2
+
+    # Timed out collector is waited for before the asset is reported failed
+    CloudblueConfig._instance = None
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['collectorWorkers'] = 8
+    config._misc['collectorTimeout'] = 0.1
+    finished = threading.Event()
+
+    def collect_consumption(*args):
+        time.sleep(0.5)
+        finished.set()
+        return 0
+
+    with patch('cloudblue_connector.consumption.FloatingIP.collect_consumption', side_effect=collect_consumption):
+        with pytest.raises(ConsumptionError, match='Floating_IP_consumption: timed out'):
+            _base_test_process_usage(
+                additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+                expected_process_exception=ConsumptionError,
+                patched_config=config
+            )
+        assert finished.is_set()
+
+
+def test_process_usage_shared_measures():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # CPU and RAM are collected with one request of instance measures
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['gnocchiSharedMeasures'] = True
+    gnocchi_mock_data = copy.deepcopy(GNOCCHI_MOCK_DATA)
+    del gnocchi_mock_data['aggregates.fetch'][()][
+        (('resource_type', 'instance'), ('operations', '(aggregate sum (metric memory mean))'),)]
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+        gnocchi_mock_data=gnocchi_mock_data,
+        expected_value_checker=make_usage_values_checker(
+            {
+                'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+            }
+        ),
+        patched_config=config
+    )
+
+
+def _storage_test_process_usage(volumes, storage_consumption):
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    gnocchi_mock_data = copy.deepcopy(GNOCCHI_MOCK_DATA)
+    gnocchi_mock_data['aggregates.fetch'][()][
+        (('resource_type', 'volume'), ('operations', STORAGE_OPERATION),)] = {'measures': volumes}
+
+    with patch('cloudblue_connector.consumption.hardware.fetch_aggregates',
+               side_effect=cache.fetch_aggregates) as fetch:
+        _base_test_process_usage(
+            additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+            gnocchi_mock_data=gnocchi_mock_data,
+            expected_value_checker=make_usage_values_checker(
+                {
+                    'CPU_consumption': 60, 'Storage_consumption': storage_consumption, 'RAM_consumption': 12,
+                    'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+                }
+            ),
+        )
+    # both metrics are fetched with one request
+    assert [c[1]['operations'] for c in fetch.call_args_list] == [STORAGE_OPERATION]
+
+
+def test_process_usage_storage_without_snapshots():
+    # Volume size is reported for volumes without snapshot size metric
+    _storage_test_process_usage(
+        {'11111111-1111-1111-1111-111111111121': {
+            'volume.size': {'mean': responses['response_volume_size']['measures']['aggregated']},
+        }},
+        384
+    )
+
+
+def test_process_usage_storage_partial_snapshots():
+    # Volumes are measured all day or until noon, a snapshot is measured for the last 4 hours only
+    hours = [datetime(2021, 5, 21, hour, tzinfo=pytz.utc) for hour in range(24)]
+    _storage_test_process_usage(
+        {
+            '11111111-1111-1111-1111-111111111121': {
+                'volume.size': {'mean': [[hour, 3600.0, 10.0] for hour in hours]},
+                'volume.snapshot.size': {'mean': [[hour, 3600.0, 2.0] for hour in hours[20:]]},
+            },
+            '11111111-1111-1111-1111-111111111122': {
+                'volume.size': {'mean': [[hour, 3600.0, 5.0] for hour in hours[:12]]},
+            },
+        },
+        # volumes: (15 * 12 + 10 * 12) / 24 * 24 hours, snapshot: 2 * 4 hours
+        308
+    )
+
+
+def test_process_usage_gnocchi_granularity():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Only hourly measures of CPU and RAM are requested
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['gnocchiGranularity'] = {'CPU': 3600, 'RAM': 3600}
+    gnocchi_mock_data = copy.deepcopy(GNOCCHI_MOCK_DATA)
+    measures = gnocchi_mock_data['aggregates.fetch'][()]
+    for operation in ('(aggregate sum (metric vcpus mean))', '(aggregate sum (metric memory mean))'):
+        measures[(('resource_type', 'instance'), ('operations', operation), ('granularity', 3600),)] = measures.pop(
+            (('resource_type', 'instance'), ('operations', operation),))
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+        gnocchi_mock_data=gnocchi_mock_data,
+        expected_value_checker=make_usage_values_checker(
+            {
+                'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+            }
+        ),
+        patched_config=config
+    )
+
+
+def test_process_usage_gnocchi_cache(tmp_path):
+    # Measures of the closed window are fetched from Gnocchi only once
+    for gnocchi_mock_data in (GNOCCHI_MOCK_DATA, {'aggregates.fetch': {(): {}}}):
+        # Clean global cloudblue config instance
+        CloudblueConfig._instance = None
+        config = ConnectorConfig(file='config.json.example', report_usage=True)
+        config._misc['gnocchiCachePath'] = str(tmp_path / 'gnocchi-cache.sqlite')
+
+        _base_test_process_usage(
+            additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+            gnocchi_mock_data=gnocchi_mock_data,
+            expected_value_checker=make_usage_values_checker(
+                {
+                    'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                    'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+                }
+            ),
+            patched_config=config
+        )
+
+
+def test_process_usage_catch_up():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Three missing days are reported in one run
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['catchUpDays'] = 3
+    dates = [(datetime.utcnow() - timedelta(days=days)).date() for days in (4, 3, 2)]
+    gnocchi_mock_data = {'aggregates.fetch': {(): {
+        key: daily_response(response, dates) for key, response in GNOCCHI_MOCK_DATA['aggregates.fetch'][()].items()
+    }}}
+
+    submitted = []
+    checker = make_usage_values_checker(
+        {
+            'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+            'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+        }
+    )
+
+    def expected_value_checker(records):
+        submitted.append(records)
+        checker(records)
+
+    updates = []
+    with patch('cloudblue_connector.consumption.cache._fetch', wraps=cache._fetch) as fetch, \
+            patch.object(UsageAutomation, 'update_last_report_time', autospec=True,
+                         side_effect=lambda self, project, report_time, confirmed=False:
+                         updates.append((report_time.date(), confirmed))):
+        _base_test_process_usage(
+            additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+            gnocchi_mock_data=gnocchi_mock_data,
+            additional_apiget_responses=catch_up_usage_files({1: None, 2: None, 3: None}),
+            expected_value_checker=expected_value_checker,
+            patched_config=config
+        )
+
+    assert len(submitted) == 3
+    # last report time is not moved past the first day which report is not accepted yet
+    assert updates == [(dates[0], True), (dates[1], False)]
+    # vcpus, memory, volume, floating ip, load balancer and cluster measures of all days
+    assert fetch.call_count == 6
+
+
+def test_process_usage_catch_up_one_day():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Asset one day behind is reported without looking up usage files of the following days
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['catchUpDays'] = 3
+
+    submitted = []
+    with patch.object(UsageAutomation, 'catch_up') as catch_up, \
+            patch.object(UsageAutomation, 'find_usage_files', autospec=True,
+                         wraps=UsageAutomation.find_usage_files) as find_usage_files:
+        _base_test_process_usage(
+            additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS).update(
+                last_usage_report_time=(datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d'),
+                last_usage_report_confirmed=True)),),
+            expected_value_checker=submitted.append,
+            patched_config=config
+        )
+
+    assert len(submitted) == 1
+    assert not catch_up.called
+    assert not find_usage_files.called
+
+
+def catch_up_usage_files(statuses):
+    """Responses to usage file requests of days before today by status, None if there is no report"""
+
+    responses = {}
+    for days, status in statuses.items():
+        report_name = 'Report for TestId {}'.format((datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d'))
+        usage_files = [] if status is None else [gen_fake_by_schema(UsageFileSchema(), defaults={
+            ('name',): report_name,
+            ('product',): {'id': 'PRD-063-065-206'},
+            ('description',): '',
+            ('status',): status,
+        })]
+        responses[('usage/files?in(product_id,(PRD-063-065-206))&eq(name,{})&limit=10'.format(report_name), '')] = \
+            (json.dumps(usage_files), 200)
+    return responses
+
+
+@pytest.mark.parametrize(
+    "statuses,expected_submitted,expected_updates",
+    (
+        # Failed report of a middle day stops catching up
+        ({3: 'accepted', 2: 'rejected', 1: 'accepted'}, 0, [(4, True), (3, True)]),
+        # Report being processed stops catching up
+        ({3: 'processing', 2: 'accepted', 1: 'accepted'}, 0, [(4, True)]),
+        # Removed failed report is submitted again, last report time is not moved past it
+        ({3: 'accepted', 2: None, 1: 'accepted'}, 1, [(4, True), (3, True), (2, False)]),
+        # Days reported by the previous run are not submitted again
+        ({3: 'accepted', 2: 'accepted', 1: None}, 1, [(4, True), (3, True), (2, True), (1, False)]),
+    )
+)
+def test_process_usage_catch_up_checks_reports(statuses, expected_submitted, expected_updates):
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Reports of all days submitted by the previous run are checked
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['catchUpDays'] = 3
+    dates = [(datetime.utcnow() - timedelta(days=days)).date() for days in (4, 3, 2)]
+    gnocchi_mock_data = {'aggregates.fetch': {(): {
+        key: daily_response(response, dates) for key, response in GNOCCHI_MOCK_DATA['aggregates.fetch'][()].items()
+    }}}
+
+    submitted = []
+    updates = []
+    with patch.object(UsageAutomation, 'update_last_report_time', autospec=True,
+                      side_effect=lambda self, project, report_time, confirmed=False:
+                      updates.append((report_time.date(), confirmed))):
+        _base_test_process_usage(
+            additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+            gnocchi_mock_data=gnocchi_mock_data,
+            additional_apiget_responses=catch_up_usage_files(statuses),
+            usage_file_status='accepted',
+            expected_value_checker=submitted.append,
+            patched_config=config
+        )
+
+    assert len(submitted) == expected_submitted
+    assert updates == [((datetime.utcnow() - timedelta(days=days)).date(), confirmed)
+                       for days, confirmed in expected_updates]
+
+
+@pytest.mark.parametrize(
+    "additional_keystone_mock_tuples",
+    (
+        # Project is found in the list
+        (('projects.list', [FakeProject(**PROJECT_DEFAULTS)]), ('projects.get', None)),
+        # Project missing in the list is requested separately
+        (('projects.list', []), ('projects.get', FakeProject(**PROJECT_DEFAULTS))),
+    )
+)
+def test_process_usage_keystone_prefetch(additional_keystone_mock_tuples):
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Projects are listed with one request
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['keystonePrefetch'] = True
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=additional_keystone_mock_tuples,
+        expected_value_checker=make_usage_values_checker(
+            {
+                'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+            }
+        ),
+        patched_config=config
+    )
+
+
+def test_process_usage_usage_files_prefetch():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Usage files of the report date are listed once and looked up by name
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['usageFilesPrefetch'] = True
+    report_date = (datetime.utcnow() - timedelta(days=4)).strftime('%Y-%m-%d')
+    usage_files = [
+        gen_fake_by_schema(UsageFileSchema(), defaults={
+            ('name',): 'Report for {} {}'.format(asset, report_date),
+            ('product',): {'id': 'PRD-063-065-206'},
+            ('description',): '',
+            ('status',): status,
+        })
+        for asset, status in (('AS-0000-0000-0000', 'processing'), ('TestId', 'deleted'), ('TestId', 'accepted'))
+    ]
+
+    submitted = []
+    checker = make_usage_values_checker(
+        {
+            'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+            'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+        }
+    )
+
+    def expected_value_checker(records):
+        submitted.append(records)
+        checker(records)
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS)),),
+        additional_apiget_responses={
+            ('usage/files?like(name,Report for * {})&in(product_id,(PRD-063-065-206))&limit=100'
+                .format(report_date), ''):
+                (json.dumps(usage_files), 200),
+        },
+        # the file found by a separate request would stop reporting
+        usage_file_status='processing',
+        expected_value_checker=expected_value_checker,
+        patched_config=config
+    )
+
+    assert len(submitted) == 1
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_process_usage_assets_page_size(workers):
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Assets are listed page by page
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['assetsPageSize'] = 1
+    config._misc['usageWorkers'] = workers
+    defaults_ = copy.deepcopy(MAIN_DEFAULTS)
+    defaults_.update(USAGE_DEFAULTS)
+    fake_asset = gen_fake_by_schema(AssetSchema(), defaults=defaults_)
+    # Assets are ordered by id, so pages do not depend on the order chosen by the API
+    active = 'assets?in(status,(active))&in(product.id,(PRD-063-065-206))&limit=1&order_by=id'
+    stopped = ('assets?in(status,(suspended,terminated))&in(product.id,(PRD-063-065-206))'
+               '&gt(updated,2020-06-24T17:47:38.787420)&limit=1&order_by=id')
+
+    submitted = []
+    checker = make_usage_values_checker(
+        {
+            'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+            'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+        }
+    )
+
+    def expected_value_checker(records):
+        submitted.append(records)
+        checker(records)
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS).update(
+            last_usage_report_confirmed=True)),),
+        additional_apiget_responses={
+            (active, ''): (json.dumps([fake_asset]), 200),
+            (active + '&offset=1', ''): (json.dumps([dict(fake_asset, id='AS-0000-0000-0001')]), 200),
+            # an Asset listed again on a shifted page is processed once
+            (active + '&offset=2', ''): (json.dumps([fake_asset]), 200),
+            (active + '&offset=3', ''): (json.dumps([]), 200),
+            (stopped, ''): (json.dumps([]), 200),
+        },
+        expected_value_checker=expected_value_checker,
+        patched_config=config
+    )
+
+    assert len(submitted) == 2
+
+
+def test_process_usage_gnocchi_prefetch():
+    # Clean global cloudblue config instance
+    CloudblueConfig._instance = None
+    # Prefetch consumption of all projects for the previous day
+    config = ConnectorConfig(file='config.json.example', report_usage=True)
+    config._misc['gnocchiPrefetch'] = True
+
+    _base_test_process_usage(
+        additional_keystone_mock_tuples=(('projects.get', FakeProject(**PROJECT_DEFAULTS).update(
+            last_usage_report_time=(datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d'),
+            last_usage_report_confirmed=True)),),
+        gnocchi_mock_data=GNOCCHI_PREFETCH_MOCK_DATA,
+        expected_value_checker=make_usage_values_checker(
+            {
+                'CPU_consumption': 60, 'Storage_consumption': 576, 'RAM_consumption': 12,
+                'Floating_IP_consumption': 24, 'LB_consumption': 36, 'K8S_consumption': 84,
+            }
+        ),
+        patched_config=config
+    )
+
+
 @pytest.mark.parametrize(
     "additional_keystone_mock_tuples",
     (